@@ -0,0 +1,58 @@
+"""
+Import-time benchmark for the CLI entry point and the crawler modules.
+
+    python bench_import.py [--budget 300] [--runs 5]
+
+Fails when an import is slower than the budget (ms) or pulls in the converter stack or OpenCC.
+"""
+import argparse
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = ['cli', 'engine', 'masiro_crawler', 'esj_crawler', 'sfacg_crawler', 'syosetu_crawler', 'universal_crawler']
+
+# loaded lazily, only when EPUB output or text conversion is actually used
+LAZY_MODULES = ['converter', 'ebooklib', 'markdown2', 'opencc']
+
+
+def measure(module: str) -> tuple[float, list[str]]:
+    code = (
+        'import sys, time\n'
+        'start = time.perf_counter()\n'
+        f'import {module}\n'
+        'elapsed = time.perf_counter() - start\n'
+        f'print(elapsed, *[m for m in {LAZY_MODULES!r} if m in sys.modules])\n'
+    )
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True,
+                            cwd=pathlib.Path(__file__).parent).stdout.split()
+    return float(output[0]) * 1000, output[1:]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=300, help='import time budget per module (ms)')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    failed = False
+    start = time.perf_counter()
+    for module in MODULES:
+        results = [measure(module) for _ in range(args.runs)]
+        median = statistics.median(elapsed for elapsed, _ in results)
+        loaded = results[0][1]
+        status = 'ok'
+        if median > args.budget:
+            status = 'over budget'
+            failed = True
+        if loaded:
+            status = f'eagerly imports {", ".join(loaded)}'
+            failed = True
+        print(f'{module:<20} {median:8.1f} ms  {status}')
+    print(f'total {time.perf_counter() - start:.1f} s')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import math
+import re
+from collections import Counter
+from typing import Iterable
+
+from lxml import etree
+
+
+class BoilerplateFilter:
+    """
+    Learns the DOM subtrees that repeat across the chapters of one book (navigation, ad slots,
+    recurring author notes) and strips them. Subtrees are compared by a structural hash of their
+    tag, class/id and normalized text, so a block counts as boilerplate when the same markup with
+    the same text shows up in at least min_ratio of the chapters.
+
+    Only blocks that look like page furniture are considered: scripts and ad slots, elements with a
+    class or id, containers of other elements, and blocks at the very start or end of the chapter.
+    Plain text paragraphs are story text wherever they are, so repeated dialogue lines and scene
+    breaks like <p>——————</p> are never removed.
+    """
+
+    name: str = "Boilerplate Filter"
+
+    noise_tags = {'script', 'style', 'ins', 'iframe', 'noscript'}
+    # tags of running text, a subtree made only of these without class or id is a plain paragraph
+    text_tags = {'p', 'br', 'span', 'font', 'b', 'strong', 'i', 'em', 'u', 's', 'del', 'small', 'big', 'sub', 'sup',
+                 'ruby', 'rb', 'rt', 'rp'}
+    whitespace = re.compile(r'\s+')
+
+    def __str__(self):
+        return f'[{self.name}]'
+
+    def __init__(self, min_ratio: float = 0.5, min_chapters: int = 4, min_text_length: int = 8,
+                 min_support: int = 3):
+        """
+        :param min_ratio: share of the chapters a subtree has to appear in
+        :param min_chapters: books with fewer chapters are left alone
+        :param min_text_length: shorter subtrees (blank lines, <br>) are kept unless they are scripts or ad slots
+        :param min_support: number of chapters a subtree has to appear in at least, whatever the book length
+        """
+        self.min_ratio = min_ratio
+        self.min_chapters = min_chapters
+        self.min_support = min_support
+        self.min_text_length = min_text_length
+        self.document_frequency: Counter = Counter()
+        self.chapter_count = 0
+
+    @classmethod
+    def parse(cls, html: str) -> etree._Element:
+        root = etree.HTML(f'<div>{html}</div>')
+        container = root.find('body/div') if root is not None else None
+        return container if container is not None else etree.Element('div')
+
+    @classmethod
+    def serialize(cls, root: etree._Element) -> str:
+        return (root.text or '') + ''.join(etree.tostring(child, encoding='unicode', method='html') for child in root)
+
+    def fingerprint(self, element: etree._Element, offset: int, subtrees: list) -> tuple[int, int, bool]:
+        """
+        Structural hash of a subtree, every subtree below it that may be boilerplate is recorded in `subtrees`
+        :param offset: length of the chapter text before the element
+        :param subtrees: (element, hash, text offset, text end, structural) of the subtrees long enough to judge
+        :return: hash, length of the normalized text and whether the subtree is a plain text paragraph
+        """
+        text = self.whitespace.sub(' ', element.text or '').strip()
+        child_hashes = []
+        text_length = len(text)
+        has_children = False
+        plain = element.tag in self.text_tags and element.get('class') is None and element.get('id') is None
+        for child in element:
+            if isinstance(child.tag, str):
+                child_hash, child_length, child_plain = self.fingerprint(child, offset + text_length, subtrees)
+                child_hashes.append(child_hash)
+                text_length += child_length
+                has_children = True
+                plain = plain and child_plain
+            tail = self.whitespace.sub(' ', child.tail or '').strip()
+            child_hashes.append(tail)
+            text_length += len(tail)
+        subtree_hash = hash((element.tag, element.get('class'), element.get('id'), text, tuple(child_hashes)))
+        if not plain and (text_length >= self.min_text_length or element.tag in self.noise_tags):
+            structural = (element.tag in self.noise_tags or element.get('class') is not None
+                          or element.get('id') is not None or has_children)
+            subtrees.append((element, subtree_hash, offset, offset + text_length, structural))
+        return subtree_hash, text_length, plain
+
+    def subtree_hashes(self, root: etree._Element) -> dict:
+        """
+        Hashes of the subtrees of a chapter that may be boilerplate: structural ones anywhere,
+        the others only at the start or end of the chapter text
+        """
+        subtrees = []
+        offset = len(self.whitespace.sub(' ', root.text or '').strip())
+        for child in root:
+            if isinstance(child.tag, str):
+                offset += self.fingerprint(child, offset, subtrees)[1]
+            offset += len(self.whitespace.sub(' ', child.tail or '').strip())
+        return {element: subtree_hash for element, subtree_hash, start, end, structural in subtrees
+                if structural or start == 0 or end == offset}
+
+    def learn(self, chapter_html: Iterable[str]) -> 'BoilerplateFilter':
+        """
+        Count the subtrees of one chapter, each subtree at most once per chapter
+        :param chapter_html: the HTML paragraphs of the chapter
+        :return:
+        """
+        hashes = set()
+        for html in chapter_html:
+            hashes.update(self.subtree_hashes(self.parse(html)).values())
+        self.document_frequency.update(hashes)
+        self.chapter_count += 1
+        return self
+
+    @property
+    def threshold(self) -> int:
+        return max(self.min_support, math.ceil(self.chapter_count * self.min_ratio))
+
+    def strip(self, html: str) -> tuple[str, int]:
+        """
+        Remove the outermost boilerplate subtrees of a chapter
+        :param html:
+        :return: cleaned HTML (unchanged if nothing matched) and the number of removed subtrees
+        """
+        if self.chapter_count < self.min_chapters:
+            return html, 0
+        root = self.parse(html)
+        candidates = self.subtree_hashes(root)
+        threshold = self.threshold
+        removed = [element for element, subtree_hash in candidates.items()
+                   if self.document_frequency[subtree_hash] >= threshold]
+        removed_set = set(removed)
+        removed = [element for element in removed
+                   if not any(ancestor in removed_set for ancestor in element.iterancestors())]
+        if not removed:
+            return html, 0
+        for element in removed:
+            self.remove(element)
+        return self.serialize(root), len(removed)
+
+    @classmethod
+    def remove(cls, element: etree._Element):
+        parent = element.getparent()
+        if element.tail:
+            previous = element.getprevious()
+            if previous is not None:
+                previous.tail = (previous.tail or '') + element.tail
+            else:
+                parent.text = (parent.text or '') + element.tail
+        parent.remove(element)
@@ -0,0 +1,89 @@
+import bisect
+from typing import Generic, Iterator, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class ChapterIndex(Generic[T]):
+    """
+    Chapters kept sorted by (section_order, section, chapter_order) as they are inserted, so TOC and spine
+    come out of one linear walk. Chapters arriving in order are appended, others are placed by bisection.
+    Two chapters with the same order are both kept, in insertion order, and reported as a collision.
+    """
+
+    name: str = "Chapter Index"
+
+    def __str__(self):
+        return f'[{self.name}]'
+
+    def __init__(self):
+        self.keys: list[tuple[int, int, int, int]] = []
+        self.chapters: list[T] = []
+        self.sections: list[tuple[str, int]] = []  # (name, order) by section id
+        self.explicit_orders: dict[int, str] = {}
+        self.section_ids: dict[str, int] = {}
+        self.collisions: list[str] = []
+        self.sequence = 0
+
+    def __len__(self) -> int:
+        return len(self.chapters)
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self.chapters)
+
+    def section(self, section_name: str, section_order: Optional[int] = None) -> int:
+        """
+        Register a section, or look it up by name
+        :param section_name:
+        :param section_order: None places a new section after every known one
+        :return: section id
+        """
+        section_id = self.section_ids.get(section_name)
+        if section_id is not None:
+            return section_id
+        if section_order is None:
+            section_order = max((order for _, order in self.sections), default=-1) + 1
+        elif section_order in self.explicit_orders:
+            name = self.explicit_orders[section_order]
+            self.collisions.append(f'卷 {section_name} 与 {name} 的顺序同为 {section_order}')
+            print(f'{self} 卷 {section_name} 与 {name} 的顺序同为 {section_order}，按出现顺序排列')
+        else:
+            self.explicit_orders[section_order] = section_name
+        section_id = len(self.sections)
+        self.sections.append((section_name, section_order))
+        self.section_ids[section_name] = section_id
+        return section_id
+
+    def insert(self, section_name: str, section_order: Optional[int], chapter_order: int, chapter: T,
+               chapter_name: Optional[str] = None) -> 'ChapterIndex':
+        section_id = self.section(section_name, section_order)
+        section_order = self.sections[section_id][1]
+        prefix = (section_order, section_id, chapter_order)
+        key = (*prefix, self.sequence)
+        self.sequence += 1
+        if not self.keys or key > self.keys[-1]:
+            position = len(self.keys)
+        else:
+            position = bisect.bisect_right(self.keys, key)
+        if position > 0 and self.keys[position - 1][:3] == prefix:
+            self.collisions.append(f'{section_name} 第 {chapter_order} 章 {chapter_name or ""}')
+            print(f'{self} {section_name} 中有多个章节的顺序为 {chapter_order} ({chapter_name})，按出现顺序排列')
+        self.keys.insert(position, key)
+        self.chapters.insert(position, chapter)
+        return self
+
+    def grouped(self) -> Iterator[tuple[str, list[T]]]:
+        """
+        Sections and their chapters in reading order, empty sections are skipped
+        """
+        current_section: Optional[int] = None
+        chapters: list[T] = []
+        for key, chapter in zip(self.keys, self.chapters):
+            if key[1] != current_section:
+                if chapters:
+                    yield self.sections[current_section][0], chapters
+                current_section = key[1]
+                chapters = []
+            chapters.append(chapter)
+        if chapters:
+            yield self.sections[current_section][0], chapters
@@ -0,0 +1,112 @@
+import codecs
+import re
+import threading
+from typing import Optional
+from urllib.parse import urlparse
+
+import fetch
+
+# encodings that sites declare but actually serve as their superset
+SUPERSETS = {'gb2312': 'gb18030', 'gbk': 'gb18030', 'cp936': 'gb18030', 'ascii': 'utf-8',
+             'iso8859-1': 'cp1252', 'big5': 'big5hkscs', 'shift_jis': 'cp932'}
+
+# candidates of the statistical detector, the crawled sites are UTF-8 or one of these
+CJK_ENCODINGS = ['gb18030', 'big5hkscs', 'cp932', 'euc_jp', 'euc_kr']
+
+BOMS = [(codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]
+
+
+class CharsetDetector:
+    """
+    Picks the encoding of a page from its BOM, Content-Type header or <meta> tag, and only runs
+    a statistical detector on a bounded prefix when none of them is usable. Detected encodings are
+    remembered per host, sites rarely mix encodings between pages.
+    """
+
+    header_pattern = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+    meta_pattern = re.compile(rb'<meta[^>]+?charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+    xml_pattern = re.compile(rb'^<\?xml[^>]+encoding\s*=\s*["\']([\w.:-]+)', re.IGNORECASE)
+
+    def __init__(self, sniff_size: int = 4096, detect_size: int = 32 * 1024):
+        self.sniff_size = sniff_size
+        self.detect_size = detect_size
+        self.host_encodings: dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def normalize(cls, encoding: Optional[str]) -> Optional[str]:
+        """
+        Canonical codec name of an encoding label, None if Python does not know it
+        """
+        if not encoding:
+            return None
+        try:
+            name = codecs.lookup(encoding.strip().lower()).name
+        except LookupError:
+            return None
+        return SUPERSETS.get(name, name)
+
+    @classmethod
+    def from_bom(cls, content: bytes) -> Optional[str]:
+        for bom, encoding in BOMS:
+            if content.startswith(bom):
+                return encoding
+        return None
+
+    @classmethod
+    def from_headers(cls, r: fetch.FetchResult) -> Optional[str]:
+        # requests' Response.encoding falls back to ISO-8859-1 for text/*, only an explicit charset counts
+        match = cls.header_pattern.search(r.headers.get('content-type', ''))
+        return cls.normalize(match.group(1)) if match else None
+
+    def from_meta(self, content: bytes) -> Optional[str]:
+        head = content[:self.sniff_size]
+        match = self.xml_pattern.search(head) or self.meta_pattern.search(head)
+        return self.normalize(match.group(1).decode('ascii')) if match else None
+
+    def detect(self, content: bytes) -> str:
+        """
+        Guess the encoding from a prefix of the page, valid UTF-8 is accepted without running the detector
+        and GB18030 is assumed when the detector is not installed or undecided
+        """
+        if self.decodes(content, 'utf-8'):
+            return 'utf-8'
+        try:
+            from charset_normalizer import from_bytes
+        except ImportError:
+            return 'gb18030'
+        best = from_bytes(content[:self.detect_size], cp_isolation=CJK_ENCODINGS).best()
+        encoding = self.normalize(best.encoding) if best is not None else None
+        if encoding is not None and self.decodes(content, encoding):
+            return encoding
+        return 'gb18030'
+
+    def encoding_for(self, r: fetch.FetchResult, preferred: Optional[str] = None) -> str:
+        """
+        :param r: a fully read response
+        :param preferred: encoding configured for the site, tried before anything the page declares
+        :return: codec name the body decodes with
+        """
+        content = r.content
+        host = urlparse(r.url).netloc
+        declared = [self.normalize(preferred), self.from_bom(content), self.from_headers(r), self.from_meta(content)]
+        with self.lock:
+            declared.append(self.host_encodings.get(host))
+        for encoding in declared:
+            if encoding is not None and self.decodes(content, encoding):
+                return encoding
+        encoding = self.detect(content)
+        with self.lock:
+            self.host_encodings[host] = encoding
+        return encoding
+
+    def decodes(self, content: bytes, encoding: str) -> bool:
+        sample = content[:self.detect_size]
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=len(sample) == len(content))
+        except (UnicodeDecodeError, LookupError):
+            return False
+        return True
+
+
+detector = CharsetDetector()
@@ -0,0 +1,125 @@
+import argparse
+import importlib
+import pathlib
+from typing import Optional
+
+# site name -> (module, crawler class), modules are only imported for the site that is used
+SITES: dict[str, tuple[str, str]] = {
+    'masiro': ('masiro_crawler', 'MasiroCrawler'),
+    'esj': ('esj_crawler', 'EsjCrawler'),
+    'sfacg': ('sfacg_crawler', 'SfAcgCrawler'),
+    'syosetu': ('syosetu_crawler', 'SyosetuCrawler'),
+    'universal': ('universal_crawler', 'UniversalCrawler'),
+}
+
+# epub: whole book, volumes: one EPUB per section, parts: size-capped EPUBs, txt/html: single-file bundles
+EXPORT_FORMATS = ['epub', 'volumes', 'parts', 'txt', 'html']
+
+
+def load_crawler_class(site: str):
+    module_name, class_name = SITES[site]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def crawl(args: argparse.Namespace):
+    crawler_class = load_crawler_class(args.site)
+    if args.cover is not None and not hasattr(crawler_class, 'set_cover'):
+        raise SystemExit(f'{args.site} 不支持 --cover')
+    if args.adapter is not None:
+        if args.site != 'universal':
+            raise SystemExit('--adapter 仅用于 universal')
+        crawler = crawler_class(args.adapter, args.url)
+    else:
+        crawler = crawler_class(args.url)
+    if args.cover is not None:
+        crawler.set_cover(args.cover)
+    if args.output is not None:
+        crawler.set_save_path(args.output)
+    crawler.set_image_prefetch(args.format != ['markdown'])
+    crawler.run()
+    if args.format == ['markdown']:
+        crawler.save_as_markdown()
+    else:
+        crawler.export([f for f in args.format if f != 'markdown'], args.export_path, args.max_part_size * 1024 * 1024)
+
+
+def export(args: argparse.Namespace):
+    from exporter import BookExporter
+    exporter = BookExporter().set_md_path(args.path).prepare()
+    exporter.export(args.export_path, args.format, args.max_part_size * 1024 * 1024)
+
+
+def index(args: argparse.Namespace):
+    from search_index import SearchIndex
+    search_index = SearchIndex(args.index)
+    for book_path in args.paths:
+        print(f'{book_path}: 已索引 {search_index.index_book(book_path)} 个新章节')
+    search_index.close()
+
+
+def search(args: argparse.Namespace):
+    from search_index import SearchIndex
+    search_index = SearchIndex(args.index)
+    for result in search_index.search(args.query, args.field, args.limit):
+        if 'chapter_name' in result:
+            print(f'{result["title"]} / {result["chapter_name"]}')
+        else:
+            print(f'{result["title"]} ({result["author"]})')
+    search_index.close()
+
+
+def serve(args: argparse.Namespace):
+    import service
+    service.serve(args.host, args.port, args.workers, args.jobs_path)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='novel-crawler', description='高扩展性的文本抓取器')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    crawl_parser = subparsers.add_parser('crawl', help='抓取一本书')
+    crawl_parser.add_argument('site', choices=sorted(SITES))
+    crawl_parser.add_argument('url', help='目录页地址，universal 不带 --adapter 时为配置文件路径')
+    crawl_parser.add_argument('--adapter', default=None, help='universal 的站点配置文件，例如 adapters/sfacg.json')
+    crawl_parser.add_argument('--format', nargs='+', choices=['markdown', *EXPORT_FORMATS], default=['epub'])
+    crawl_parser.add_argument('--export-path', type=pathlib.Path, default=pathlib.Path('.'), help='导出文件目录')
+    crawl_parser.add_argument('--max-part-size', type=int, default=20, help='parts 格式每个 EPUB 的大小上限 (MB)')
+    crawl_parser.add_argument('--output', type=pathlib.Path, default=None, help='markdown 输出目录')
+    crawl_parser.add_argument('--cover', default=None, help='封面地址 (esj, syosetu)')
+    crawl_parser.set_defaults(func=crawl)
+
+    export_parser = subparsers.add_parser('export', help='将已抓取的 markdown 目录一次性导出为多种格式')
+    export_parser.add_argument('path', type=pathlib.Path)
+    export_parser.add_argument('--format', nargs='+', choices=EXPORT_FORMATS, default=['epub'])
+    export_parser.add_argument('--export-path', type=pathlib.Path, default=pathlib.Path('.'), help='导出文件目录')
+    export_parser.add_argument('--max-part-size', type=int, default=20, help='parts 格式每个 EPUB 的大小上限 (MB)')
+    export_parser.set_defaults(func=export)
+
+    index_parser = subparsers.add_parser('index', help='将已抓取的 markdown 目录加入全文索引')
+    index_parser.add_argument('paths', nargs='+', type=pathlib.Path)
+    index_parser.add_argument('--index', type=pathlib.Path, default=pathlib.Path('cache') / 'search.db')
+    index_parser.set_defaults(func=index)
+
+    search_parser = subparsers.add_parser('search', help='搜索书名、作者或正文')
+    search_parser.add_argument('query')
+    search_parser.add_argument('--field', choices=['title', 'author', 'body'], default=None)
+    search_parser.add_argument('--limit', type=int, default=20)
+    search_parser.add_argument('--index', type=pathlib.Path, default=pathlib.Path('cache') / 'search.db')
+    search_parser.set_defaults(func=search)
+
+    serve_parser = subparsers.add_parser('serve', help='启动本地抓取服务 (HTTP API)')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--workers', type=int, default=2, help='同时运行的任务数')
+    serve_parser.add_argument('--jobs-path', type=pathlib.Path, default=pathlib.Path('jobs'), help='任务状态与输出目录')
+    serve_parser.set_defaults(func=serve)
+    return parser
+
+
+def main(argv: Optional[list[str]] = None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
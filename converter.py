@@ -1,14 +1,19 @@
+import datetime
 from typing import Optional
 from markdown2 import Markdown
-from converter_models import ConverterConfig, ChapterMeta, SectionDict, BookMeta
-import requests
+from converter_models import ConverterConfig, ChapterMeta, BookMeta
+import fetch
 from lxml import etree
-import xml.etree.ElementTree as ET
 import abc
 from ebooklib import epub
 import pathlib
 import json
-from bs4 import BeautifulSoup
+import re
+import uuid
+from image_cache import ImageCache
+from fingerprint import FingerprintIndex
+from chapter_index import ChapterIndex
+from epub_packager import write_epub
 
 
 class BasicChapterConverter:
@@ -37,6 +42,23 @@ class BasicChapterConverter:
             md_content: str = f.read()
         return self._convert_md_to_html(md_content)
 
+    def convert_directory(self, md_path: pathlib.Path) -> list[tuple[int, pathlib.Path, str, ChapterMeta]]:
+        """
+        Convert every chapter of a markdown directory
+        :param md_path:
+        :return: (number in file name order, path, html, meta) in reading order, chapters without orders last
+        """
+        chapters = []
+        for number, chapter_path in enumerate(sorted(md_path.glob('*.md')), 1):
+            chapter_content, chapter_meta = self.convert_from_path(chapter_path)
+            chapters.append((number, chapter_path, chapter_content, chapter_meta))
+        last = float('inf')
+        chapters.sort(key=lambda chapter: (
+            last if chapter[3].section_order is None else chapter[3].section_order,
+            last if chapter[3].chapter_order is None else chapter[3].chapter_order,
+            chapter[0]))
+        return chapters
+
 
 class EPUBConverter:
     """
@@ -45,17 +67,36 @@ class EPUBConverter:
 
     name: str = "EPUB Converter"
 
+    html_parser = etree.HTMLParser(recover=True, remove_comments=True, remove_pis=True)
+    invalid_xml_chars = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+    xml_name = re.compile(r'^[A-Za-z_][\w.\-]*$')
+
     def __str__(self):
         return f"[{self.name}]"
 
-    def __init__(self, config: ConverterConfig, proxy: Optional[dict] = None):
+    def __init__(self, config: ConverterConfig, proxy: Optional[dict] = None, image_cache: Optional[ImageCache] = None):
         self.config = config
         self.epub_book = epub.EpubBook()
-        self.section_dict: dict[str, SectionDict] = {
-            'default': SectionDict(section_name='default', section_order=0, section_content={})
-        }
+        self.chapter_index: ChapterIndex[epub.EpubHtml] = ChapterIndex()
         self.total_chapter_count = 1
         self.proxy = proxy
+        self.fallback_chapters: list[str] = []
+        self.image_cache = image_cache
+        self.source_date: Optional[datetime.datetime] = None
+        self.fingerprint_index: Optional[FingerprintIndex] = FingerprintIndex() if config.deduplicate else None
+        self.fingerprint_names: dict[str, str] = {}
+
+    def fetch_image(self, url: str) -> bytes:
+        """
+        Read an image from the prefetch cache, downloading it directly on a cache miss
+        :param url:
+        :return:
+        """
+        if self.image_cache is not None:
+            content = self.image_cache.get(url)
+            if content is not None:
+                return content
+        return fetch.fetch(url, headers=self.config.download_headers, proxies=self.proxy, page=False).content
 
     def load_meta_from_file(self, book_meta: BookMeta, file_path: pathlib.Path) -> 'EPUBConverter':
         if book_meta.title is not None:
@@ -70,10 +111,7 @@ class EPUBConverter:
         if book_meta.cover is not None:
             if book_meta.cover.startswith('http'):
                 try:
-                    if self.proxy is not None:
-                        self.set_cover("cover", requests.get(book_meta.cover, headers=self.config.download_headers, proxies=self.proxy).content)
-                    else:
-                        self.set_cover("cover", requests.get(book_meta.cover, headers=self.config.download_headers).content)
+                    self.set_cover("cover", self.fetch_image(book_meta.cover))
                 except Exception as e:
                     print(e)
             else:
@@ -86,9 +124,17 @@ class EPUBConverter:
             self.set_publisher(book_meta.publisher)
         if book_meta.identifier is not None:
             self.set_identifier(book_meta.identifier)
+        else:
+            # ebooklib defaults to a random uuid4, which would make every build differ
+            self.set_identifier(str(uuid.uuid5(uuid.NAMESPACE_URL, book_meta.title)))
         if book_meta.meta is not None:
             for key, value in book_meta.meta.items():
                 self.add_metadata(key, value)
+        if book_meta.modified is not None:
+            try:
+                self.source_date = datetime.datetime.fromisoformat(book_meta.modified)
+            except ValueError:
+                print(f'{self} modified {book_meta.modified} 不是 ISO 8601 日期，忽略')
         return self
 
     def set_style(self, style: str) -> 'EPUBConverter':
@@ -128,73 +174,168 @@ class EPUBConverter:
         return self
 
     def add_section(self, section_name: str, section_order: Optional[int]) -> 'EPUBConverter':
-        if section_name == '':
-            section_name = 'default'
-        if section_name not in self.section_dict:
-            if section_order is None:
-                self.section_dict[section_name] = SectionDict(section_name=section_name, section_order=len(self.section_dict), section_content={})
-            else:
-                self.section_dict[section_name] = SectionDict(section_name=section_name, section_order=section_order, section_content={})
+        self.chapter_index.section(section_name, section_order)
         return self
 
     def add_chapter(self, section_name: str, chapter_content: str, chapter_meta: ChapterMeta, file_path: pathlib.Path) -> 'EPUBConverter':
         self.total_chapter_count += 1
-        if section_name == '':
-            section_name = 'default'
-        if section_name not in self.section_dict:
-            self.add_section(section_name, chapter_meta.section_order)
+        if self.is_duplicate(chapter_content, chapter_meta, file_path):
+            return self
+        chapter_content = self.process_html(chapter_content, file_path, chapter_meta.chapter_name)
+        return self.add_xhtml_chapter(section_name, chapter_content, chapter_meta)
+
+    def add_xhtml_chapter(self, section_name: str, chapter_content, chapter_meta: ChapterMeta) -> 'EPUBConverter':
+        """
+        Add a chapter whose content was already normalized by process_html
+        :param section_name:
+        :param chapter_content:
+        :param chapter_meta:
+        :return:
+        """
         new_chapter = epub.EpubHtml(title=chapter_meta.chapter_name, file_name=f'{chapter_meta.chapter_name}.xhtml', lang=self.config.lang, )
-        chapter_content = self.process_html(chapter_content, file_path)
         new_chapter.set_content(chapter_content)
-        self.section_dict[section_name].section_content[chapter_meta.chapter_order] = new_chapter
+        chapter_order = chapter_meta.chapter_order if chapter_meta.chapter_order is not None else self.total_chapter_count
+        self.chapter_index.insert(section_name, chapter_meta.section_order, chapter_order, new_chapter,
+                                  chapter_meta.chapter_name)
         return self
 
+    def register_image(self, img_name: str, img_data: bytes) -> 'EPUBConverter':
+        if self.epub_book.get_item_with_href(f"images/{img_name}") is None:
+            self.epub_book.add_item(epub.EpubItem(file_name=f"images/{img_name}", content=img_data, media_type='image/jpeg'))
+        return self
+
+    def is_duplicate(self, chapter_content: str, chapter_meta: ChapterMeta, md_path: pathlib.Path) -> bool:
+        """
+        Check a chapter against the flag written by the crawler and the chapters converted so far
+        :param chapter_content:
+        :param chapter_meta:
+        :param md_path: markdown directory, a crawler flag is only trusted if its target was written there too
+        :return:
+        """
+        if self.fingerprint_index is None:
+            return False
+        duplicate_of = chapter_meta.duplicate_of
+        if duplicate_of is not None and not (md_path / f'{duplicate_of}.md').exists():
+            duplicate_of = None
+        if duplicate_of is None:
+            key = f'{chapter_meta.section_order}/{chapter_meta.chapter_order}'
+            self.fingerprint_names.setdefault(key, chapter_meta.chapter_name)
+            duplicate_of = self.fingerprint_index.check(key, chapter_content)
+            if duplicate_of is not None:
+                duplicate_of = self.fingerprint_names[duplicate_of]
+        if duplicate_of is None:
+            return False
+        print(f'{self} 章节 {chapter_meta.chapter_name} 与 {duplicate_of} 重复，跳过')
+        return True
+
     @abc.abstractmethod
     def convert(self) -> epub.EpubBook:
         pass
 
-    def process_html(self, html: str, file_path: pathlib.Path) -> str:
+    def build_toc(self) -> 'EPUBConverter':
+        """
+        Add the chapters of every section to the book in order and build TOC and spine
+        :return:
+        """
+        sections = list(self.chapter_index.grouped())
+        for section_name, chapters in sections:
+            for chapter in chapters:
+                self.epub_book.add_item(chapter)
+            if len(sections) == 1 or not section_name:
+                section_name = '正文'
+            self.epub_book.toc.append((epub.Section(section_name), chapters))
+            self.epub_book.spine.extend(chapters)
+        self.epub_book.add_item(epub.EpubNcx())
+        self.epub_book.add_item(epub.EpubNav())
+        if self.fallback_chapters:
+            print(f'{self} {len(self.fallback_chapters)} 个章节未能转换为 XHTML: {", ".join(self.fallback_chapters)}')
+        return self
+
+    def save_to_file(self, file_path: pathlib.Path) -> 'EPUBConverter':
+        """
+        Save epub to file
+        :param file_path:
+        :return:
+        """
+        write_epub(file_path.absolute(), self.epub_book, {"epub3_pages": False}, self.source_date,
+                   self.config.package_workers)
+        return self
+
+    def process_html(self, html: str, file_path: pathlib.Path, chapter_name: Optional[str] = None):
+        """
+        Normalize a chapter HTML fragment into well-formed XHTML in a single pass
+        :param html: chapter HTML fragment
+        :param file_path: directory used to resolve local images
+        :param chapter_name: chapter name used when reporting a fallback
+        :return: XHTML bytes, or the raw HTML if normalization failed
+        """
         html = "<html><body>" + html + "</body></html>"
         try:
-            soup = BeautifulSoup(html, 'html.parser')
-            root = ET.fromstring(str(soup.prettify()))
-            return ET.tostring(self.download_image(root, file_path), encoding='utf-8')
+            root = etree.fromstring(self.invalid_xml_chars.sub('', html), self.html_parser)
+            self.normalize_tree(root, file_path)
+            return etree.tostring(root, encoding='utf-8', method='xml')
         except Exception as e:
-            print(e)
+            chapter_name = chapter_name if chapter_name is not None else str(file_path)
+            self.fallback_chapters.append(chapter_name)
+            print(f'{self} 章节 {chapter_name} 转换为 XHTML 失败，使用原始 HTML: {e}')
             return html
 
+    def normalize_tree(self, root: etree.Element, file_path: pathlib.Path) -> etree.Element:
+        """
+        Drop names that are not valid XML and localize images while walking the tree once
+        :param root:
+        :param file_path:
+        :return:
+        """
+        invalid_tags = []
+        for element in root.iter(tag=etree.Element):
+            if not self.xml_name.match(element.tag):
+                invalid_tags.append(element)
+                continue
+            for attr in [attr for attr in element.attrib if not self.xml_name.match(attr)]:
+                del element.attrib[attr]
+            if element.tag == 'img':
+                self.localize_image(element, file_path)
+        for element in invalid_tags:
+            element.tag = 'invalid-xml-name'
+            element.attrib.clear()
+        if invalid_tags:
+            etree.strip_tags(root, 'invalid-xml-name')
+        return root
+
     def download_image(self, root: etree.Element, file_path: pathlib.Path) -> etree.Element:
-        for img in root.findall('.//img'):
-            img_url = img.get('src')
-            if img_url is not None:
-                img_url = img_url.strip()
-                if img_url.startswith('http'):
-                    if self.proxy is not None:
-                        img_data = requests.get(img_url, headers=self.config.download_headers, proxies=self.proxy).content
-                    else:
-                        img_data = requests.get(img_url, headers=self.config.download_headers).content
-                    img_name = img_url.split('/')[-1]
-                    self.epub_book.add_item(epub.EpubItem(file_name=f"images/{img_name}", content=img_data, media_type='image/jpeg'))
-                    img.set('src', f"images/{img_name}")
-                else:
-                    img_path = file_path / pathlib.Path(img.get('src'))
-                    if img_path.exists():
-                        img_data = img_path.read_bytes()
-                        img_name = img_path.name
-                        self.epub_book.add_item(epub.EpubItem(file_name=f"images/{img_name}", content=img_data, media_type='image/jpeg'))
-                        img.set('src', f"images/{img_name}")
-                    else:
-                        raise FileNotFoundError(f"Image not found: {img_path}")
+        for img in root.iter('img'):
+            self.localize_image(img, file_path)
         return root
 
+    def localize_image(self, img: etree.Element, file_path: pathlib.Path):
+        img_url = img.get('src')
+        if img_url is None:
+            return
+        img_url = img_url.strip()
+        if img_url.startswith('http'):
+            img_data = self.fetch_image(img_url)
+            img_name = img_url.split('/')[-1]
+            self.register_image(img_name, img_data)
+            img.set('src', f"images/{img_name}")
+        else:
+            img_path = file_path / pathlib.Path(img_url)
+            if img_path.exists():
+                img_data = img_path.read_bytes()
+                img_name = img_path.name
+                self.register_image(img_name, img_data)
+                img.set('src', f"images/{img_name}")
+            else:
+                raise FileNotFoundError(f"Image not found: {img_path}")
+
 
 class Markdowns2EpubConverter(EPUBConverter):
     """
     Markdown to EPUB converter
     """
 
-    def __init__(self, config: ConverterConfig = ConverterConfig(), proxy: Optional[dict] = None):
-        super(Markdowns2EpubConverter, self).__init__(config, proxy)
+    def __init__(self, config: ConverterConfig = ConverterConfig(), proxy: Optional[dict] = None, image_cache: Optional[ImageCache] = None):
+        super(Markdowns2EpubConverter, self).__init__(config, proxy, image_cache)
         self.chapter_converter = BasicChapterConverter(self.config)
         self.md_path: Optional[pathlib.Path] = None
 
@@ -205,51 +346,18 @@ class Markdowns2EpubConverter(EPUBConverter):
         """
         if self.md_path is None:
             raise ValueError("Path not set")
-        for chapter_path in self.md_path.iterdir():
-            if chapter_path.is_dir():
-                continue
-            if not chapter_path.suffix == '.md':
-                continue
-            chapter_content, chapter_meta = self.chapter_converter.convert_from_path(chapter_path)
+        # duplicates are judged in reading order, the later copy of a chapter is the one dropped
+        for number, chapter_path, chapter_content, chapter_meta in self.chapter_converter.convert_directory(self.md_path):
             if chapter_meta.chapter_name is None:
                 if chapter_meta.show_chapter_order:
-                    chapter_meta.chapter_name = f"第{self.total_chapter_count}章 {chapter_path.stem}"
+                    chapter_meta.chapter_name = f"第{number}章 {chapter_path.stem}"
                 else:
                     chapter_meta.chapter_name = chapter_path.stem
             if chapter_meta.chapter_order is None:
-                chapter_meta.chapter_order = self.total_chapter_count
-            if chapter_meta.section_order is None:
-                chapter_meta.section_order = len(self.section_dict)
-            if chapter_meta.section_name:
-                self.add_chapter(chapter_meta.section_name, chapter_content, chapter_meta, chapter_path.parent)
-            else:
-                self.add_chapter("", chapter_content, chapter_meta, chapter_path.parent)
-
-        section_list = [_ for key, _ in self.section_dict.items()]
-        section_list.sort(key=lambda x: x.section_order)
-        if len(section_list) == 1:
-            chapter_list = [(key, value) for key, value in section_list[0].section_content.items()]
-            chapter_list.sort(key=lambda x: x[0])
-            chapters = [value for _, value in chapter_list]
-            for chapter in chapters:
-                self.epub_book.add_item(chapter)
-            self.epub_book.toc = [(epub.Section('正文'), chapters)]
-            self.epub_book.spine = chapters
-        else:
-            section_list.sort(key=lambda x: x.section_order)
-            for section in section_list:
-                if section.section_name == 'default':
-                    continue
-                chapter_list = [(key, value) for key, value in section.section_content.items()]
-                chapter_list.sort(key=lambda x: x[0])
-                chapters = [value for _, value in chapter_list]
-                for chapter in chapters:
-                    self.epub_book.add_item(chapter)
-                self.epub_book.toc.append((epub.Section(section.section_name), chapters))
-                self.epub_book.spine.extend(chapters)
-        self.epub_book.add_item(epub.EpubNcx())
-        self.epub_book.add_item(epub.EpubNav())
-        return self
+                chapter_meta.chapter_order = number
+            self.add_chapter(chapter_meta.section_name or '', chapter_content, chapter_meta, chapter_path.parent)
+
+        return self.build_toc()
 
     def set_md_path(self, path: pathlib.Path) -> 'EPUBConverter':
         """
@@ -270,13 +378,3 @@ class Markdowns2EpubConverter(EPUBConverter):
 
     def _create_book(self) -> epub.EpubBook:
         return self.epub_book
-
-    def save_to_file(self, file_path: pathlib.Path) -> 'EPUBConverter':
-        """
-        Save epub to file
-        :param file_path:
-        :return:
-        """
-        epub.write_epub(file_path.absolute(), self.epub_book, {"epub3_pages": False})
-        return self
-
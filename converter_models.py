@@ -2,13 +2,14 @@ import enum
 
 from pydantic import BaseModel
 from typing import Optional
-from ebooklib import epub
 
 
 class ConverterConfig(BaseModel):
     convert_image: bool = True
     style: Optional[str] = None
     lang: Optional[str] = None
+    deduplicate: bool = False  # drop near-duplicate chapters (reposts, 修正版 re-uploads) from the EPUB
+    package_workers: Optional[int] = None  # threads compressing EPUB entries, None for one per CPU
     download_headers: dict[str, str] = {
         "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) "
                       "Chrome/103.0.0.0 Safari/537.36 "
@@ -27,14 +28,7 @@ class ChapterMeta(BaseModel):
     chapter_name: Optional[str] = None
     chapter_type: ChapterType = ChapterType.NOVEL
     show_chapter_order: bool = True
-
-
-class SectionDict(BaseModel):
-    class Config:
-        arbitrary_types_allowed = True
-    section_name: str
-    section_order: int
-    section_content: dict[int, epub.EpubHtml]
+    duplicate_of: Optional[str] = None
 
 
 class BookMeta(BaseModel):
@@ -46,4 +40,5 @@ class BookMeta(BaseModel):
     cover: Optional[str] = None
     publisher: Optional[str] = None
     identifier: Optional[str] = None
+    modified: Optional[str] = None  # ISO 8601, dcterms:modified and ZIP timestamps of the EPUB
 
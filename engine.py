@@ -2,21 +2,60 @@ import pathlib
 import requests
 import json
 import abc
-from models import Paragraph, Chapter, Section, Book
+import re
+import time
+import functools
+import fetch
+import charset
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional
+from models import Paragraph, Chapter, Section, Book, TocEntry
 from pathlib import Path
-from converter import Markdowns2EpubConverter
+from image_cache import ImageCache
+from locked_chapters import LockedChapterCache
+from fingerprint import FingerprintIndex
 from pydantic import BaseModel
 
 
 requests.DEFAULT_RETRIES = 20
 
 
+@functools.lru_cache(maxsize=None)
+def get_text_converter(config: str = 't2s'):
+    """
+    Shared OpenCC converter, opencc and its dictionaries are only loaded on first use
+    :param config: OpenCC config name
+    :return:
+    """
+    import opencc
+    return opencc.OpenCC(config)
+
+
+def prompt(message: str, interactive: bool = True) -> str:
+    """
+    Ask the user for a value the site or config did not provide
+    :param message:
+    :param interactive: False fails instead of blocking on stdin, for crawlers run by the job service
+    :return:
+    """
+    if not interactive:
+        raise ValueError(f'{message.rstrip(": ：")} (not asked, the crawler is not interactive)')
+    return input(message)
+
+
 class CrawlerConfig(BaseModel):
     headers: dict
     config: dict = {}
 
 
 class BaseCrawler:
+    interactive: bool = True
+    text_converter_config: Optional[str] = None  # OpenCC config of the crawler, e.g. 't2s'
+    backoff_markers: list[str] = []
+    paywall_markers: list[str] = []
+    img_src_pattern = re.compile(r'<img\b[^>]*?\ssrc\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
+
     def __init__(self, book_url):
         self.book_url = book_url
         self.config = self.parse_config()
@@ -24,25 +63,204 @@ class BaseCrawler:
         self.book: Book = Book()
         self.out_put_path = Path('output')
         self.out_put_path.mkdir(exist_ok=True)
+        self.section_index: dict[int, Section] = {}
+        self.locked_chapters = LockedChapterCache(recheck=self.config.config.get('recheck_locked', False))
+        self.image_cache = ImageCache(headers=self.headers, proxy=self.config.config.get('proxy'),
+                                      max_age=self.config.config.get('image_max_age'))
+        self.progress_callbacks: list[Callable[[str, dict], None]] = []
+        self.image_prefetch: bool = self.config.config.get('prefetch_images', False)
+        if 'concurrency' in self.config.config:
+            fetch.controller.configure(**self.config.config['concurrency'])
 
     def set_headers(self, headers) -> 'BaseCrawler':
         self.headers = headers
+        self.image_cache.headers = headers
+        return self
+
+    @property
+    def text_converter(self):
+        """
+        OpenCC converter of text_converter_config, OpenCC is only loaded when text is first converted
+        """
+        return get_text_converter(self.text_converter_config) if self.text_converter_config else None
+
+    def set_interactive(self, interactive: bool) -> 'BaseCrawler':
+        """
+        :param interactive: False makes a missing value (e.g. a cover url) fail the crawl instead of prompting
+        :return:
+        """
+        self.interactive = interactive
+        return self
+
+    def set_image_prefetch(self, enabled: bool) -> 'BaseCrawler':
+        """
+        Download images in the background during the crawl, only worth it when an EPUB or export is built
+        afterwards. An explicit 'prefetch_images' config takes precedence
+        :param enabled:
+        :return:
+        """
+        self.image_prefetch = self.config.config.get('prefetch_images', enabled)
+        return self
+
+    def add_progress_callback(self, callback: Callable[[str, dict], None]) -> 'BaseCrawler':
+        """
+        :param callback: called with an event name ('book_info', 'chapter') and its data, from the crawling thread
+        :return:
+        """
+        self.progress_callbacks.append(callback)
         return self
 
+    def report(self, event: str, **data):
+        for callback in self.progress_callbacks:
+            callback(event, data)
+
     def _get_html(self, url: str) -> str:
+        return self.decode(self._request(url))
+
+    def encoding_for(self, r: fetch.FetchResult) -> str:
+        return charset.detector.encoding_for(r, self.config.config.get('encoding'))
+
+    def decode(self, r: fetch.FetchResult) -> str:
+        """
+        Decode a page without letting requests run charset detection over the whole body
+        :param r:
+        :return:
+        """
+        return r.content.decode(self.encoding_for(r), errors='replace')
+
+    def _get_chapter_html(self, url: str) -> Optional[str]:
+        r = self._get_chapter_response(url)
+        return self.decode(r) if r is not None else None
+
+    def _get_chapter_response(self, url: str) -> Optional[fetch.FetchResult]:
+        """
+        Fetch a chapter page, aborting the download as soon as a paywall marker is seen
+        :param url:
+        :return: None if the chapter is locked
+        """
+        if self.locked_chapters.is_locked(url):
+            print(f'{url} 已知为付费章节，跳过')
+            return None
+        paywall_markers = [*self.paywall_markers, *self.config.config.get('paywall_markers', [])]
+        try:
+            r = self._request(url, paywall_markers)
+        except fetch.PaywallError as e:
+            self.locked_chapters.add(url, e.marker)
+            print(f'{url} 为付费章节，跳过')
+            return None
+        if url in self.locked_chapters.locked:
+            # unlocked since an earlier run, only reachable with recheck_locked
+            self.locked_chapters.remove(url)
+        return r
+
+    def _request(self, url: str, paywall_markers: Iterable[str] = ()) -> fetch.FetchResult:
+        max_retries = self.config.config.get('max_retries', requests.DEFAULT_RETRIES)
+        retries = 0
         while True:
             try:
-                if 'proxy' in self.config.config:
-                    r = requests.get(url, headers=self.headers, proxies=self.config.config['proxy'])
-                else:
-                    r = requests.get(url, headers=self.headers)
-                return r.text
+                return fetch.fetch(url, headers=self.headers, proxies=self.config.config.get('proxy'),
+                                   timeout=self.config.config.get('timeout', 30),
+                                   backoff_markers=[*self.backoff_markers, *self.config.config.get('backoff_markers', [])],
+                                   paywall_markers=paywall_markers)
+            except fetch.PaywallError:
+                raise
             except Exception as e:
+                retries += 1
+                if retries > max_retries:
+                    raise
                 print(f"在请求{url}时发生错误: {e}，正在重试...")
+                time.sleep(min(2 ** retries, 60) if isinstance(e, fetch.ThrottledError) else 1)
                 continue
 
+    def fetch_metrics(self) -> dict[str, dict]:
+        """
+        Per-host concurrency limit and request statistics of the fetch layer
+        :return:
+        """
+        return fetch.controller.metrics()
+
+    def prefetch_images(self, chapter: Chapter) -> Chapter:
+        """
+        Hand the images of a parsed chapter to the background prefetcher
+        :param chapter:
+        :return:
+        """
+        if not self.image_prefetch:
+            return chapter
+        for paragraph in chapter.paragraphs:
+            if paragraph.type == Paragraph.ParagraphType.Image:
+                self.image_cache.prefetch(paragraph.content)
+            elif paragraph.type == Paragraph.ParagraphType.HTML:
+                for img_url in self.img_src_pattern.findall(paragraph.content):
+                    self.image_cache.prefetch(img_url)
+        return chapter
+
+    def prefetch_cover(self):
+        if self.image_prefetch:
+            self.image_cache.prefetch(self.book.meta.cover)
+
     def add_section(self, section: Section):
         self.book.sections.append(section)
+        self.section_index[section.section_order] = section
+
+    def add_chapter(self, entry: TocEntry, chapter: Optional[Chapter]) -> 'BaseCrawler':
+        """
+        Attach a parsed chapter to the section its TOC entry belongs to
+        :param entry:
+        :param chapter: None when the chapter was skipped
+        :return:
+        """
+        self.report('chapter', chapter_order=entry.chapter_order, section_name=entry.section_name,
+                    chapter_name=chapter.metadata.chapter_name if chapter is not None else None,
+                    skipped=chapter is None)
+        if chapter is None:
+            return self
+        if entry.section_order not in self.section_index:
+            self.add_section(Section(section_name=entry.section_name, section_order=entry.section_order))
+        chapter.metadata.section_name = entry.section_name
+        chapter.metadata.section_order = entry.section_order
+        chapter.metadata.chapter_order = entry.chapter_order
+        self.section_index[entry.section_order].section_content.append(chapter)
+        return self
+
+    def crawl_chapters(self, entries: Iterable[TocEntry]) -> Iterator[tuple[TocEntry, Optional[Chapter]]]:
+        """
+        Parse the chapters of a TOC stream in order, keeping at most a small window of chapters in flight
+        :param entries:
+        :return: (entry, chapter) pairs in TOC order
+        """
+        workers = self.config.config.get('chapter_workers', 1)
+        if workers <= 1:
+            for entry in entries:
+                if self.is_locked(entry):
+                    yield entry, None
+                    continue
+                yield entry, self.parse(entry.chapter_url)
+            return
+        window: deque = deque()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chapter') as executor:
+            for entry in entries:
+                if self.is_locked(entry):
+                    window.append((entry, None))
+                else:
+                    window.append((entry, executor.submit(self.parse, entry.chapter_url)))
+                if len(window) >= workers * 2:
+                    entry, future = window.popleft()
+                    yield entry, None if future is None else future.result()
+            while window:
+                entry, future = window.popleft()
+                yield entry, None if future is None else future.result()
+
+    def is_locked(self, entry: TocEntry) -> bool:
+        """
+        Pre-classify a TOC entry from its markup or an earlier run, before any request is made
+        :param entry:
+        :return:
+        """
+        if entry.locked:
+            print(f'{entry.chapter_url} 在目录中标记为付费章节，跳过')
+            return True
+        return self.locked_chapters.is_locked(entry.chapter_url)
 
     def set_save_path(self, path: Path) -> 'BaseCrawler':
         if not path.exists():
@@ -56,27 +274,116 @@ class BaseCrawler:
             file.unlink()
         self.save_book_meta()
         self.save_chapters()
+        if 'search_index' in self.config.config:
+            self.update_search_index(Path(self.config.config['search_index']))
+
+    def update_search_index(self, index_path: Path):
+        from search_index import SearchIndex
+        search_index = SearchIndex(index_path)
+        print(f'已索引 {search_index.index_book(self.out_put_path)} 个新章节')
+        search_index.close()
 
     def save_as_epub(self):
+        from converter import Markdowns2EpubConverter
         self.out_put_path = Path('output')
         self.save_as_markdown()
         if "proxy" in self.config.config:
-            converter = Markdowns2EpubConverter(proxy=self.config.config['proxy'])
+            converter = Markdowns2EpubConverter(proxy=self.config.config['proxy'], image_cache=self.image_cache)
         else:
-            converter = Markdowns2EpubConverter()
+            converter = Markdowns2EpubConverter(image_cache=self.image_cache)
         converter.set_md_path(self.out_put_path)
         converter.convert().save_to_file(pathlib.Path(f'{self.book.meta.title}.epub'))
 
+    def export(self, formats: Iterable[str], out_path: Path = Path('.'), max_part_size: int = 20 * 1024 * 1024) -> list[Path]:
+        """
+        Save as markdown, then write several formats (epub, volumes, parts, txt, html) sharing one conversion pass
+        :param formats:
+        :param out_path:
+        :param max_part_size: size cap of one EPUB part in bytes, used by 'parts'
+        :return: written files
+        """
+        from exporter import BookExporter
+        self.save_as_markdown()
+        exporter = BookExporter(proxy=self.config.config.get('proxy'), image_cache=self.image_cache)
+        return exporter.set_md_path(self.out_put_path).prepare().export(out_path, formats, max_part_size)
+
     def save_book_meta(self):
         with open(self.out_put_path / 'book_meta.json', 'w', encoding='utf-8') as f:
             json.dump(self.book.meta.dict(), f, indent=4, ensure_ascii=False)
 
+    def strip_boilerplate(self) -> int:
+        """
+        Remove the DOM subtrees repeated across the chapters of the book (navigation, ads, recurring notes)
+        before they are stored. Off unless the 'strip_boilerplate' config is true, options of BoilerplateFilter
+        can be set in the 'boilerplate' config
+        :return: bytes saved
+        """
+        if not self.config.config.get('strip_boilerplate', False):
+            return 0
+        from boilerplate import BoilerplateFilter
+        boilerplate_filter = BoilerplateFilter(**self.config.config.get('boilerplate', {}))
+        chapters = [chapter for section in self.book.sections for chapter in section.section_content]
+        for chapter in chapters:
+            boilerplate_filter.learn(paragraph.content for paragraph in chapter.paragraphs
+                                     if paragraph.type == Paragraph.ParagraphType.HTML)
+        size_before = size_after = removed = 0
+        for chapter in chapters:
+            for paragraph in chapter.paragraphs:
+                if paragraph.type != Paragraph.ParagraphType.HTML:
+                    continue
+                size_before += len(paragraph.content.encode('utf-8'))
+                paragraph.content, count = boilerplate_filter.strip(paragraph.content)
+                size_after += len(paragraph.content.encode('utf-8'))
+                removed += count
+        if removed:
+            print(f'{boilerplate_filter} 去除 {removed} 处重复内容，节省 {(size_before - size_after) / 1024:.1f} KB '
+                  f'({(size_before - size_after) / size_before:.1%})')
+        return size_before - size_after
+
     def save_chapters(self):
+        self.strip_boilerplate()
+        dedup = self.config.config.get('dedup', 'flag')
+        fingerprint_index = None
+        if dedup != 'off':
+            # rebuilt from the chapters of this crawl, a duplicate always points at a chapter written below
+            fingerprint_index = FingerprintIndex.for_book(self.book.meta.identifier or self.book.meta.title,
+                                                          rebuild=True)
+        chapter_names: dict[str, str] = {}
         for section in self.book.sections:
             for chapter in section.section_content:
                 chapter.metadata.chapter_name = chapter.metadata.chapter_name.replace('/', '_')
+                chapter_names[self.fingerprint_key(chapter)] = chapter.metadata.chapter_name
+                if fingerprint_index is not None and self.mark_duplicate(fingerprint_index, chapter, chapter_names):
+                    duplicate_of = chapter.metadata.meta['duplicate_of']
+                    if dedup == 'drop':
+                        print(f'{chapter.metadata.chapter_name} 与 {duplicate_of} 重复，跳过')
+                        continue
+                    print(f'{chapter.metadata.chapter_name} 与 {duplicate_of} 重复，已标记 duplicate_of')
                 with open(self.out_put_path / f'{chapter.metadata.chapter_name}.md', 'w', encoding='utf-8') as f:
                     f.write(self.chapter2md(chapter))
+        if fingerprint_index is not None:
+            fingerprint_index.save()
+
+    @classmethod
+    def fingerprint_key(cls, chapter: Chapter) -> str:
+        return f'{chapter.metadata.section_order}/{chapter.metadata.chapter_order}'
+
+    @classmethod
+    def mark_duplicate(cls, fingerprint_index: FingerprintIndex, chapter: Chapter, chapter_names: dict[str, str]) -> bool:
+        """
+        Flag a chapter whose text is a near-duplicate of one already in the index (reposts, 修正版 re-uploads)
+        :param fingerprint_index:
+        :param chapter:
+        :param chapter_names: chapter name by fingerprint key, for the chapters checked so far
+        :return: True if the chapter was flagged with meta['duplicate_of']
+        """
+        text = ''.join(paragraph.content for paragraph in chapter.paragraphs
+                       if paragraph.type in (Paragraph.ParagraphType.Text, Paragraph.ParagraphType.HTML))
+        duplicate_of = fingerprint_index.check(cls.fingerprint_key(chapter), text)
+        if duplicate_of is None:
+            return False
+        chapter.metadata.meta = {**(chapter.metadata.meta or {}), 'duplicate_of': chapter_names[duplicate_of]}
+        return True
 
     @classmethod
     def chapter2md(cls, chapter: Chapter) -> str:
@@ -104,8 +411,22 @@ class BaseCrawler:
             f'{paragraph.content}\n'
         return f'{paragraph.content}\n'
 
-    @abc.abstractmethod
     def crawl(self):
+        self.crawl_book_info()
+        self.report('book_info', title=self.book.meta.title, author=self.book.meta.author)
+        for entry, chapter in self.crawl_chapters(self.iter_toc()):
+            self.add_chapter(entry, chapter)
+
+    @abc.abstractmethod
+    def crawl_book_info(self):
+        pass
+
+    @abc.abstractmethod
+    def iter_toc(self) -> Iterator[TocEntry]:
+        """
+        Walk the table of contents lazily, following paginated indexes as they are consumed
+        :return:
+        """
         pass
 
     @abc.abstractmethod
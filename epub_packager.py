@@ -0,0 +1,137 @@
+import datetime
+import os
+import pathlib
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
+
+from ebooklib import epub
+
+# already compressed formats gain nothing from deflate
+STORED_SUFFIXES = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.m4a', '.woff', '.woff2'}
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+UTF8_NAME_FLAG = 0x800
+
+# build date when neither SOURCE_DATE_EPOCH nor the book sets one, the earliest date a ZIP can hold
+DEFAULT_SOURCE_DATE = datetime.datetime(1980, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class ZipEntry:
+
+    def __init__(self, name: str, data: bytes, stored: bool):
+        self.name = name
+        self.data = data
+        self.stored = stored
+        self.method = ZIP_STORED
+        self.crc = 0
+        self.payload = data
+
+    def compress(self, level: int) -> 'ZipEntry':
+        self.crc = zlib.crc32(self.data)
+        if not self.stored:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            payload = compressor.compress(self.data) + compressor.flush()
+            if len(payload) < len(self.data):
+                self.method = ZIP_DEFLATED
+                self.payload = payload
+        return self
+
+
+class EntryCollector:
+    """
+    Stands in for the zipfile.ZipFile of EpubWriter and only records what would be written
+    """
+
+    def __init__(self):
+        self.entries: list[ZipEntry] = []
+
+    def writestr(self, name: str, data: Union[str, bytes], compress_type: Optional[int] = None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        stored = compress_type == ZIP_STORED or pathlib.PurePosixPath(name).suffix.lower() in STORED_SUFFIXES
+        self.entries.append(ZipEntry(name, data, stored))
+
+
+class ParallelEpubWriter(epub.EpubWriter):
+    """
+    EpubWriter that deflates the entries on a thread pool (zlib releases the GIL) and writes the ZIP
+    container itself: mimetype first and stored, entries in ebooklib's order, one fixed timestamp,
+    so the same book always packs to the same bytes.
+    """
+
+    def __init__(self, name, book, options=None, max_workers: Optional[int] = None):
+        super(ParallelEpubWriter, self).__init__(name, book, options)
+        self.max_workers = max_workers
+
+    def write(self):
+        self.out = EntryCollector()
+        self.out.writestr('mimetype', 'application/epub+zip', compress_type=ZIP_STORED)
+        self._write_container()
+        self._write_opf()
+        self._write_items()
+        level = self.options['compresslevel']
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='epub-deflate') as executor:
+            entries = list(executor.map(lambda entry: entry.compress(level), self.out.entries))
+        with open(self.file_name, 'wb') as f:
+            write_zip(f, entries, self.options['mtime'])
+
+
+def dos_datetime(mtime: datetime.datetime) -> tuple[int, int]:
+    mtime = max(mtime, datetime.datetime(1980, 1, 1, tzinfo=mtime.tzinfo))
+    dos_date = (mtime.year - 1980) << 9 | mtime.month << 5 | mtime.day
+    dos_time = mtime.hour << 11 | mtime.minute << 5 | mtime.second // 2
+    return dos_time, dos_date
+
+
+def write_zip(f, entries: list[ZipEntry], mtime: datetime.datetime):
+    """
+    Write prepared entries as a plain (non-ZIP64) archive
+    :param f: binary file
+    :param entries: compressed entries, in archive order
+    :param mtime: timestamp of every entry
+    """
+    dos_time, dos_date = dos_datetime(mtime)
+    central_directory = []
+    offset = 0
+    for entry in entries:
+        name = entry.name.encode('utf-8')
+        flags = 0 if entry.name.isascii() else UTF8_NAME_FLAG
+        if offset > 0xFFFFFFFF or len(entry.data) > 0xFFFFFFFF:
+            raise ValueError('EPUB too large for a non-ZIP64 archive')
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, entry.method, dos_time, dos_date,
+                             entry.crc, len(entry.payload), len(entry.data), len(name), 0)
+        f.write(header)
+        f.write(name)
+        f.write(entry.payload)
+        central_directory.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, flags, entry.method,
+                                             dos_time, dos_date, entry.crc, len(entry.payload), len(entry.data),
+                                             len(name), 0, 0, 0, 0, 0, offset) + name)
+        offset += len(header) + len(name) + len(entry.payload)
+    central_directory = b''.join(central_directory)
+    f.write(central_directory)
+    f.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(entries), len(entries), len(central_directory), offset, 0))
+
+
+def build_time(source_date: Optional[datetime.datetime] = None) -> datetime.datetime:
+    """
+    dcterms:modified of a build: SOURCE_DATE_EPOCH when set, else the date of the book, else a fixed date.
+    Never taken from the clock or file mtimes, so the same content always packs to the same bytes
+    """
+    if 'SOURCE_DATE_EPOCH' in os.environ:
+        return datetime.datetime.fromtimestamp(int(os.environ['SOURCE_DATE_EPOCH']), datetime.timezone.utc)
+    if source_date is None:
+        return DEFAULT_SOURCE_DATE
+    if source_date.tzinfo is None:
+        source_date = source_date.replace(tzinfo=datetime.timezone.utc)
+    return source_date.astimezone(datetime.timezone.utc).replace(microsecond=0)
+
+
+def write_epub(name: pathlib.Path, book: epub.EpubBook, options: Optional[dict] = None,
+               source_date: Optional[datetime.datetime] = None, max_workers: Optional[int] = None):
+    options = {**(options or {}), 'mtime': build_time(source_date)}
+    writer = ParallelEpubWriter(name, book, options, max_workers)
+    writer.process()
+    writer.write()
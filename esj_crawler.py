@@ -1,10 +1,9 @@
-from engine import BaseCrawler
-from models import Section, Chapter, Book, ChapterMeta, Paragraph, ChapterType, BookMeta
+from engine import BaseCrawler, get_text_converter
+from models import Section, Chapter, Book, ChapterMeta, Paragraph, ChapterType, BookMeta, TocEntry
 import re
-from typing import Optional
+from typing import Iterator, Optional
 from bs4 import BeautifulSoup
 from bs4.element import NavigableString
-import opencc
 
 
 class EsjCrawler(BaseCrawler):
@@ -13,10 +12,12 @@ class EsjCrawler(BaseCrawler):
         super().__init__(url)
         self.root_url = 'https://www.esjzone.cc/'
         self.cover_url = ''
+        self.book_info_page: Optional[BeautifulSoup] = None
 
-    def crawl(self):
+    def crawl_book_info(self):
         html = self._get_html(self.book_url)
-        book_info_page = BeautifulSoup(html, 'html.parser')
+        self.book_info_page = BeautifulSoup(html, 'html.parser')
+        book_info_page = self.book_info_page
         book_detail = book_info_page.find('div', class_='book-detail')
         self.book.meta.title = self.process_text(book_detail.h2.text)
 
@@ -30,45 +31,33 @@ class EsjCrawler(BaseCrawler):
         self.book.meta.language = 'zh-CN'
         self.book.meta.identifier = 'Esj_book_' + self.book_url.replace(self.root_url, '').replace('/', '')
         self.book.meta.meta = {'source': self.book_url}
-        chapter_ul = book_info_page.find('div', id='chapterList')
+        self.prefetch_cover()
+
+    def iter_toc(self) -> Iterator[TocEntry]:
+        if self.book_info_page is None:
+            self.crawl_book_info()
+        chapter_ul = self.book_info_page.find('div', id='chapterList')
         section_count: int = 0
         chapter_count: int = 0
-        current_section: Optional[Section] = Section(section_name="番外", section_order=section_count)
+        section_name: str = "番外"
         for li in chapter_ul:
             if isinstance(li, NavigableString):
                 continue
             if li.name == 'p':
-                if current_section is not None:
-                    if len(current_section.section_content) > 0:
-                        self.book.sections.append(current_section)
                 section_name = self.sanitize_filename(self.process_text(li.text))
                 section_count += 1
-                current_section = Section(section_name=section_name, section_order=section_count)
             elif li.name == 'a':
                 chapter_count += 1
-                current_chapter = self.parse(li['href'])
-                current_chapter.metadata.section_name = current_section.section_name
-                current_chapter.metadata.section_order = current_section.section_order
-                current_chapter.metadata.chapter_order = chapter_count
-                current_section.section_content.append(current_chapter)
+                yield TocEntry(section_name=section_name, section_order=section_count,
+                               chapter_url=li['href'], chapter_order=chapter_count)
             elif li.name == 'details':
-                if current_section is not None:
-                    if len(current_section.section_content) > 0:
-                        self.book.sections.append(current_section)
                 section_name = self.sanitize_filename(self.process_text(li.summary.text))
                 section_count += 1
-                current_section = Section(section_name=section_name, section_order=section_count)
                 for a in li:
                     if a.name == 'a':
                         chapter_count += 1
-                        current_chapter = self.parse(a['href'])
-                        current_chapter.metadata.section_name = current_section.section_name
-                        current_chapter.metadata.section_order = current_section.section_order
-                        current_chapter.metadata.chapter_order = chapter_count
-                        current_section.section_content.append(current_chapter)
-
-        if current_section is not None:
-            self.book.sections.append(current_section)
+                        yield TocEntry(section_name=section_name, section_order=section_count,
+                                       chapter_url=a['href'], chapter_order=chapter_count)
 
     def parse(self, chapter_url: str) -> Chapter:
         chapter = Chapter()
@@ -79,6 +68,7 @@ class EsjCrawler(BaseCrawler):
         chapter.paragraphs.append(title)
         content_box = chapter_page.find(class_='forum-content')
         chapter.paragraphs.append(Paragraph(type=Paragraph.ParagraphType.HTML, content=self.process_text(content_box.prettify())))
+        self.prefetch_images(chapter)
         print("Parsed chapter: " + chapter.metadata.chapter_name)
         return chapter
 
@@ -92,7 +82,7 @@ class EsjCrawler(BaseCrawler):
         :param text:
         :return:
         """
-        converter = opencc.OpenCC('t2s')
+        converter = get_text_converter('t2s')
         text = converter.convert(text)
         return text
 
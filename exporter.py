@@ -0,0 +1,249 @@
+import json
+import pathlib
+import re
+from typing import Iterable, Optional
+
+from lxml import etree
+from pydantic import BaseModel
+
+from chapter_index import ChapterIndex
+from converter import BasicChapterConverter, EPUBConverter
+from converter_models import BookMeta, ChapterMeta, ConverterConfig
+from image_cache import ImageCache
+
+
+class PreparedChapter(BaseModel):
+    section_name: str
+    meta: ChapterMeta
+    content: bytes
+    images: list[str] = []
+
+
+class BookExporter(EPUBConverter):
+    """
+    Parses, normalizes and downloads the images of a Markdown book once, then writes any
+    number of output formats from the prepared chapters
+    """
+
+    name: str = "Book Exporter"
+
+    xhtml_parser = etree.HTMLParser(encoding='utf-8', recover=True)
+    block_tags = ('p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+    def __init__(self, config: ConverterConfig = ConverterConfig(), proxy: Optional[dict] = None,
+                 image_cache: Optional[ImageCache] = None):
+        super(BookExporter, self).__init__(config, proxy, image_cache)
+        self.chapter_converter = BasicChapterConverter(self.config)
+        self.md_path: Optional[pathlib.Path] = None
+        self.book_meta = BookMeta(title='Unknown')
+        self.cover: Optional[bytes] = None
+        self.prepared: ChapterIndex[PreparedChapter] = ChapterIndex()
+        self.images: dict[str, bytes] = {}
+        self.chapter_images: list[str] = []
+
+    def set_md_path(self, path: pathlib.Path) -> 'BookExporter':
+        if not path.exists():
+            raise ValueError("Path not exists")
+        if not path.is_dir():
+            raise ValueError("Path is not a directory")
+        self.md_path = path
+        if (path / 'book_meta.json').exists():
+            with (path / 'book_meta.json').open('r', encoding="utf-8") as f:
+                self.book_meta = BookMeta(**json.load(f))
+            self.load_meta_from_file(self.book_meta, path / 'book_meta.json')
+        return self
+
+    def set_cover(self, file_name, content, create_page=True) -> 'BookExporter':
+        self.cover = content
+        return self
+
+    def register_image(self, img_name: str, img_data: bytes) -> 'BookExporter':
+        self.images[img_name] = img_data
+        self.chapter_images.append(img_name)
+        return self
+
+    def convert(self) -> 'BookExporter':
+        return self.prepare()
+
+    def prepare(self) -> 'BookExporter':
+        """
+        Convert and normalize every chapter once, images are downloaded a single time for all formats
+        :return:
+        """
+        if self.md_path is None:
+            raise ValueError("Path not set")
+        # duplicates are judged in reading order, the later copy of a chapter is the one dropped
+        for number, chapter_path, chapter_content, chapter_meta in self.chapter_converter.convert_directory(self.md_path):
+            if chapter_meta.chapter_name is None:
+                if chapter_meta.show_chapter_order:
+                    chapter_meta.chapter_name = f"第{number}章 {chapter_path.stem}"
+                else:
+                    chapter_meta.chapter_name = chapter_path.stem
+            if chapter_meta.chapter_order is None:
+                chapter_meta.chapter_order = number
+            self.total_chapter_count += 1
+            if self.is_duplicate(chapter_content, chapter_meta, chapter_path.parent):
+                continue
+            self.chapter_images = []
+            content = self.process_html(chapter_content, chapter_path.parent, chapter_meta.chapter_name)
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            self.prepared.insert(chapter_meta.section_name or '', chapter_meta.section_order, chapter_meta.chapter_order,
+                                 PreparedChapter(section_name=chapter_meta.section_name or '', meta=chapter_meta,
+                                                 content=content, images=self.chapter_images),
+                                 chapter_meta.chapter_name)
+        if self.fallback_chapters:
+            print(f'{self} {len(self.fallback_chapters)} 个章节未能转换为 XHTML: {", ".join(self.fallback_chapters)}')
+        return self
+
+    def export(self, out_path: pathlib.Path, formats: Iterable[str], max_part_size: int = 20 * 1024 * 1024) -> list[pathlib.Path]:
+        """
+        Write several formats from the prepared chapters
+        :param out_path: output directory
+        :param formats: any of 'epub', 'volumes', 'parts', 'txt', 'html'
+        :param max_part_size: size cap of one EPUB part in bytes, before compression
+        :return: written files
+        """
+        out_path.mkdir(parents=True, exist_ok=True)
+        title = self.sanitize(self.book_meta.title or 'Unknown')
+        written = []
+        for export_format in formats:
+            if export_format == 'epub':
+                written.append(self.export_epub(self.chapters, out_path / f'{title}.epub'))
+            elif export_format == 'volumes':
+                written.extend(self.export_volumes(out_path))
+            elif export_format == 'parts':
+                written.extend(self.export_parts(out_path, max_part_size))
+            elif export_format == 'txt':
+                written.append(self.export_txt(out_path / f'{title}.txt'))
+            elif export_format == 'html':
+                written.append(self.export_html(out_path / f'{title}.html'))
+            else:
+                raise ValueError(f'Unknown format {export_format}')
+        return written
+
+    def export_epub(self, chapters: list[PreparedChapter], file_path: pathlib.Path,
+                    title_suffix: Optional[str] = None, part: Optional[int] = None) -> pathlib.Path:
+        book_meta = self.book_meta.copy(update={'cover': None})
+        if title_suffix is not None:
+            book_meta.title = f'{book_meta.title} {title_suffix}'
+        if part is not None and book_meta.identifier is not None:
+            book_meta.identifier = f'{book_meta.identifier}_{part}'
+        converter = EPUBConverter(self.config.copy(update={'deduplicate': False}), self.proxy)
+        converter.load_meta_from_file(book_meta, self.md_path / 'book_meta.json')
+        converter.source_date = self.source_date
+        if self.cover is not None:
+            converter.set_cover('cover', self.cover)
+        for chapter in chapters:
+            for img_name in chapter.images:
+                converter.register_image(img_name, self.images[img_name])
+            converter.add_xhtml_chapter(chapter.section_name, chapter.content, chapter.meta)
+        converter.build_toc().save_to_file(file_path)
+        print(f'{self} 已生成 {file_path}')
+        return file_path
+
+    def export_volumes(self, out_path: pathlib.Path) -> list[pathlib.Path]:
+        """
+        One EPUB per section (volume)
+        :param out_path:
+        :return:
+        """
+        written = []
+        title = self.sanitize(self.book_meta.title or 'Unknown')
+        for part, (section_name, chapters) in enumerate(self.group_by_section(), start=1):
+            written.append(self.export_epub(chapters, out_path / f'{title} {part:02d} {self.sanitize(section_name)}.epub',
+                                            title_suffix=section_name, part=part))
+        return written
+
+    def export_parts(self, out_path: pathlib.Path, max_part_size: int) -> list[pathlib.Path]:
+        """
+        EPUBs of consecutive chapters, each holding at most max_part_size bytes of content and images
+        :param out_path:
+        :param max_part_size:
+        :return:
+        """
+        parts: list[list[PreparedChapter]] = [[]]
+        part_size = 0
+        part_images: set[str] = set()
+        for chapter in self.chapters:
+            chapter_size = len(chapter.content) + sum(len(self.images[img_name]) for img_name in set(chapter.images)
+                                                      if img_name not in part_images)
+            if parts[-1] and part_size + chapter_size > max_part_size:
+                parts.append([])
+                part_size = 0
+                part_images = set()
+                chapter_size = len(chapter.content) + sum(len(self.images[img_name]) for img_name in set(chapter.images))
+            parts[-1].append(chapter)
+            part_size += chapter_size
+            part_images.update(chapter.images)
+        title = self.sanitize(self.book_meta.title or 'Unknown')
+        return [self.export_epub(chapters, out_path / f'{title} {part:02d}.epub', title_suffix=f'({part})', part=part)
+                for part, chapters in enumerate(parts, start=1) if chapters]
+
+    def export_txt(self, file_path: pathlib.Path) -> pathlib.Path:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(f'{self.book_meta.title}\n')
+            if self.book_meta.author:
+                f.write(f'{" ".join(self.book_meta.author)}\n')
+            if self.book_meta.description:
+                f.write(f'\n{self.book_meta.description.strip()}\n')
+            for section_name, chapters in self.group_by_section():
+                f.write(f'\n\n{section_name}\n')
+                for chapter in chapters:
+                    f.write(f'\n{self.chapter_text(chapter)}\n')
+        print(f'{self} 已生成 {file_path}')
+        return file_path
+
+    def export_html(self, file_path: pathlib.Path) -> pathlib.Path:
+        """
+        A single HTML file, images are written next to it in images/
+        :param file_path:
+        :return:
+        """
+        image_path = file_path.parent / 'images'
+        image_path.mkdir(exist_ok=True)
+        for img_name, img_data in self.images.items():
+            (image_path / img_name).write_bytes(img_data)
+        root = etree.Element('html')
+        head = etree.SubElement(root, 'head')
+        etree.SubElement(head, 'meta', charset='utf-8')
+        etree.SubElement(head, 'title').text = self.book_meta.title
+        if self.config.style is not None:
+            etree.SubElement(head, 'style').text = self.config.style
+        body = etree.SubElement(root, 'body')
+        for section_name, chapters in self.group_by_section():
+            section = etree.SubElement(body, 'section')
+            etree.SubElement(section, 'h1').text = section_name
+            for chapter in chapters:
+                article = etree.SubElement(section, 'article')
+                chapter_body = self.chapter_body(chapter)
+                article.text = chapter_body.text
+                article.extend(list(chapter_body))
+        with open(file_path, 'wb') as f:
+            f.write(b'<!DOCTYPE html>\n')
+            f.write(etree.tostring(root, encoding='utf-8', method='html'))
+        print(f'{self} 已生成 {file_path}')
+        return file_path
+
+    @property
+    def chapters(self) -> list[PreparedChapter]:
+        return self.prepared.chapters
+
+    def group_by_section(self) -> list[tuple[str, list[PreparedChapter]]]:
+        return [(section_name or '正文', chapters) for section_name, chapters in self.prepared.grouped()]
+
+    def chapter_body(self, chapter: PreparedChapter) -> etree.Element:
+        root = etree.fromstring(chapter.content, self.xhtml_parser)
+        body = root.find('body')
+        return body if body is not None else root
+
+    def chapter_text(self, chapter: PreparedChapter) -> str:
+        body = self.chapter_body(chapter)
+        for element in body.iter(*self.block_tags):
+            element.tail = '\n' + (element.tail or '')
+        lines = (line.strip() for line in etree.tostring(body, encoding='unicode', method='text').splitlines())
+        return '\n'.join(line for line in lines if line)
+
+    @classmethod
+    def sanitize(cls, filename: str) -> str:
+        return re.sub(r'[\\/:*?"<>|]', '_', filename).strip()
@@ -0,0 +1,295 @@
+import http.cookiejar
+import threading
+import time
+from typing import BinaryIO, Callable, Iterable, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+
+
+class ThrottledError(Exception):
+    """
+    Raised when a host answers with a rate limit or an anti-bot page
+    """
+
+    def __init__(self, url: str, reason: str):
+        super().__init__(f'{url} 被限流: {reason}')
+        self.url = url
+        self.reason = reason
+
+
+class PaywallError(Exception):
+    """
+    Raised when a streamed page turns out to be a paywall, the rest of the body is never downloaded
+    """
+
+    def __init__(self, url: str, marker: str):
+        super().__init__(f'{url} 为付费章节: {marker}')
+        self.url = url
+        self.marker = marker
+
+
+class FetchResult:
+    """
+    Status, headers and body of a fetched url, the body is fully read (or went to a sink) when this is returned
+    """
+
+    def __init__(self, url: str, status_code: int, headers, content: bytes, wire_bytes: int, decoded_bytes: int):
+        """
+        :param url: final url, after redirects
+        :param headers: case-insensitive response headers
+        :param content: decoded body, empty when it was written to a sink
+        :param wire_bytes: body bytes received, before decompression
+        :param decoded_bytes: body bytes after decompression, including what went to a sink
+        """
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.wire_bytes = wire_bytes
+        self.decoded_bytes = decoded_bytes
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'HTTP {self.status_code} for url {self.url}')
+
+
+class HostLimiter:
+    """
+    AIMD limit on the number of in-flight requests to one host.
+    The limit grows by roughly one slot per window of healthy responses and is
+    multiplied by decrease_factor on timeouts, errors and throttled responses.
+    """
+
+    def __init__(self, host: str, initial_limit: float = 2, min_limit: float = 1, max_limit: float = 16,
+                 decrease_factor: float = 0.5, latency_threshold: float = 10.0):
+        self.host = host
+        self.limit = float(initial_limit)
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.decrease_factor = decrease_factor
+        self.latency_threshold = latency_threshold
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.average_latency: Optional[float] = None
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self.not_modified = 0
+        self.partial = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float, healthy: bool, throttled: bool = False):
+        with self.condition:
+            self.in_flight -= 1
+            self.requests += 1
+            if self.average_latency is None:
+                self.average_latency = latency
+            else:
+                self.average_latency = 0.8 * self.average_latency + 0.2 * latency
+            if throttled:
+                self.throttled += 1
+            elif not healthy:
+                self.errors += 1
+            if healthy and latency < self.latency_threshold:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif not healthy:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self.condition.notify_all()
+
+    def record_transfer(self, wire_bytes: int, decoded_bytes: int, status_code: int):
+        """
+        :param wire_bytes: body bytes received, before decompression
+        :param decoded_bytes: body bytes after decompression
+        :param status_code:
+        """
+        with self.condition:
+            self.wire_bytes += wire_bytes
+            self.decoded_bytes += decoded_bytes
+            if status_code == 304:
+                self.not_modified += 1
+            elif status_code == 206:
+                self.partial += 1
+
+    def snapshot(self) -> dict:
+        with self.condition:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'errors': self.errors,
+                'throttled': self.throttled,
+                'average_latency': self.average_latency,
+                'wire_bytes': self.wire_bytes,
+                'decoded_bytes': self.decoded_bytes,
+                'compression_ratio': self.wire_bytes / self.decoded_bytes if self.decoded_bytes else None,
+                'not_modified': self.not_modified,
+                'partial': self.partial,
+            }
+
+
+class AdaptiveConcurrencyController:
+    """
+    Keeps one HostLimiter per host so every site runs near its own optimum
+    """
+
+    def __init__(self, **limiter_options):
+        self.limiter_options = limiter_options
+        self.limiters: dict[str, HostLimiter] = {}
+        self.lock = threading.Lock()
+
+    def configure(self, **limiter_options) -> 'AdaptiveConcurrencyController':
+        """
+        Change the options used for hosts that have not been contacted yet
+        :param limiter_options: keyword arguments of HostLimiter
+        :return:
+        """
+        with self.lock:
+            self.limiter_options.update(limiter_options)
+        return self
+
+    def limiter(self, url: str) -> HostLimiter:
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter(host, **self.limiter_options)
+            return self.limiters[host]
+
+    def metrics(self) -> dict[str, dict]:
+        with self.lock:
+            limiters = list(self.limiters.values())
+        return {limiter.host: limiter.snapshot() for limiter in limiters}
+
+
+controller = AdaptiveConcurrencyController()
+
+throttle_status_codes = {429, 503}
+
+# gzip and deflate, plus br / zstd when urllib3 finds brotli or zstandard installed, so we never
+# advertise an encoding that cannot be decoded
+accept_encoding = ', '.join(ACCEPT_ENCODING.split(','))
+
+# one connection pool per host shared by every crawler, cookies are not kept between requests
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+anti_bot_markers = [
+    'cf-browser-verification',
+    'cf_chl_opt',
+    '<title>Just a moment...</title>',
+]
+
+
+def _encode_markers(markers: Iterable[str]) -> list[tuple[str, bytes]]:
+    encoded = []
+    for marker in markers:
+        for encoding in ('utf-8', 'gb18030'):
+            marker_bytes = marker.encode(encoding, errors='ignore')
+            if marker_bytes and (marker, marker_bytes) not in encoded:
+                encoded.append((marker, marker_bytes))
+    return encoded
+
+
+def _contains_marker(content: bytes, markers: Iterable[str]) -> Optional[str]:
+    for marker, marker_bytes in _encode_markers(markers):
+        if marker_bytes in content:
+            return marker
+    return None
+
+
+def _read_body(r: requests.Response, markers: Iterable[str] = (), sink: Optional[BinaryIO] = None,
+               chunk_size: int = 8192) -> tuple[Optional[str], bytes, int]:
+    """
+    Stream and decompress the body of a response, stopping as soon as one of the markers shows up
+    :param r: response opened with stream=True
+    :param markers:
+    :param sink: file the body is written to instead of being collected
+    :param chunk_size:
+    :return: the marker found (None if the whole body was read), the collected body and the number of decoded bytes
+    """
+    encoded = _encode_markers(markers)
+    overlap = max((len(marker_bytes) for _, marker_bytes in encoded), default=1) - 1
+    chunks = []
+    tail = b''
+    decoded_bytes = 0
+    for chunk in r.iter_content(chunk_size):
+        decoded_bytes += len(chunk)
+        if encoded:
+            window = tail + chunk
+            for marker, marker_bytes in encoded:
+                if marker_bytes in window:
+                    return marker, b'', decoded_bytes
+            tail = window[-overlap:] if overlap > 0 else b''
+        if sink is not None:
+            sink.write(chunk)
+        else:
+            chunks.append(chunk)
+    return None, b''.join(chunks), decoded_bytes
+
+
+def fetch(url: str, headers: Optional[dict] = None, proxies: Optional[dict] = None, timeout: float = 30,
+          backoff_markers: Iterable[str] = (), paywall_markers: Iterable[str] = (),
+          sink: Optional[Callable[[requests.Response], Optional[BinaryIO]]] = None, page: bool = True,
+          encoding: Optional[str] = None) -> FetchResult:
+    """
+    GET a url through the per-host adaptive concurrency limit and the shared session.
+    The body is negotiated compressed and decompressed while it streams in.
+    :param url:
+    :param headers: Accept-Encoding is always set by the fetch layer, see `encoding`
+    :param proxies:
+    :param timeout:
+    :param backoff_markers: extra page markers that mean the host is throttling us
+    :param paywall_markers: page markers of locked content, the body is streamed and dropped once one is seen
+    :param sink: called with the response before its body is read, may return a file to write the body to
+    :param page: the url is an HTML page, False for images and other binary downloads whose bytes
+                 must not be scanned for anti-bot markers
+    :param encoding: Accept-Encoding to send instead of the negotiated ones, 'identity' for Range requests
+                     whose offsets have to count the bytes on the wire
+    :return:
+    """
+    headers = {key: value for key, value in (headers or {}).items() if key.lower() != 'accept-encoding'}
+    headers['Accept-Encoding'] = encoding or accept_encoding
+    limiter = controller.limiter(url)
+    limiter.acquire()
+    start = time.monotonic()
+    healthy = False
+    throttled = False
+    try:
+        r = session.get(url, headers=headers, proxies=proxies, timeout=timeout, stream=True)
+        if r.status_code in throttle_status_codes:
+            r.close()
+            throttled = True
+            raise ThrottledError(url, f'HTTP {r.status_code}')
+        decoded_bytes = 0
+        try:
+            marker, content, decoded_bytes = _read_body(r, paywall_markers, sink(r) if sink is not None else None)
+        except Exception:
+            r.close()
+            raise
+        finally:
+            wire_bytes = r.raw.tell()
+            limiter.record_transfer(wire_bytes, decoded_bytes, r.status_code)
+        if marker is not None:
+            # the rest of the body is dropped, a fully read body has already released the connection
+            r.close()
+            healthy = True
+            raise PaywallError(url, marker)
+        marker = _contains_marker(content, [*anti_bot_markers, *backoff_markers]) if page else None
+        if marker is not None:
+            throttled = True
+            raise ThrottledError(url, marker)
+        healthy = r.status_code < 500
+        return FetchResult(r.url, r.status_code, r.headers, content, wire_bytes, decoded_bytes)
+    finally:
+        limiter.release(time.monotonic() - start, healthy, throttled)
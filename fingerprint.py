@@ -0,0 +1,118 @@
+import hashlib
+import json
+import pathlib
+import re
+import threading
+from typing import Optional
+
+# every bit of a shingle hash gets its own LANE_WIDTH-bit lane in one big integer, so the per-bit
+# votes of all shingles are summed with plain integer additions instead of a 64-step loop per shingle
+LANE_WIDTH = 32
+LANE_MASK = (1 << LANE_WIDTH) - 1
+BYTE_LANES = [sum((byte >> bit & 1) << (bit * LANE_WIDTH) for bit in range(8)) for byte in range(256)]
+
+
+class FingerprintIndex:
+    """
+    SimHash index of the chapter texts of one book, used to spot reposts and re-uploaded chapters.
+    Fingerprints are split into bands so that any fingerprint within max_distance bits
+    shares at least one band with its near-duplicates and lookups stay cheap.
+    """
+
+    tag_pattern = re.compile(r'<[^>]+>')
+    noise_pattern = re.compile(r'[\W_]+', re.UNICODE)
+
+    def __init__(self, index_file: Optional[pathlib.Path] = None, max_distance: int = 3, min_length: int = 200,
+                 shingle_size: int = 3, rebuild: bool = False):
+        """
+        :param index_file: where the index is persisted, None to keep it in memory
+        :param rebuild: start empty and replace index_file on save, so entries of chapters no longer in the book go away
+        """
+        self.index_file = index_file
+        self.max_distance = max_distance
+        self.min_length = min_length
+        self.shingle_size = shingle_size
+        self.band_count = max_distance + 1
+        self.band_width = 64 // self.band_count
+        self.fingerprints: dict[str, int] = {}
+        self.bands: list[dict[int, set[str]]] = [{} for _ in range(self.band_count)]
+        self.lock = threading.Lock()
+        if self.index_file is not None and self.index_file.exists() and not rebuild:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                for key, fingerprint in json.load(f).items():
+                    self._add(key, int(fingerprint, 16))
+
+    @classmethod
+    def for_book(cls, identifier: str, cache_path: pathlib.Path = pathlib.Path('cache') / 'fingerprints',
+                 **options) -> 'FingerprintIndex':
+        file_name = re.sub(r'[\\/:*?"<>|]', '_', identifier) + '.json'
+        return cls(cache_path / file_name, **options)
+
+    @classmethod
+    def clean_text(cls, html: str) -> str:
+        return cls.noise_pattern.sub('', cls.tag_pattern.sub('', html))
+
+    def simhash(self, text: str) -> int:
+        shingle_count = max(1, len(text) - self.shingle_size + 1)
+        lanes = 0
+        for i in range(shingle_count):
+            digest = hashlib.blake2b(text[i:i + self.shingle_size].encode('utf-8'), digest_size=8).digest()
+            for position, byte in enumerate(digest):
+                lanes += BYTE_LANES[byte] << (position * 8 * LANE_WIDTH)
+        fingerprint = 0
+        for bit in range(64):
+            if 2 * (lanes >> (bit * LANE_WIDTH) & LANE_MASK) > shingle_count:
+                fingerprint |= 1 << bit
+        return fingerprint
+
+    def _band_keys(self, fingerprint: int) -> list[int]:
+        mask = (1 << self.band_width) - 1
+        return [fingerprint >> (i * self.band_width) & mask for i in range(self.band_count)]
+
+    def _add(self, key: str, fingerprint: int):
+        self.fingerprints[key] = fingerprint
+        for band, band_key in zip(self.bands, self._band_keys(fingerprint)):
+            band.setdefault(band_key, set()).add(key)
+
+    def find_duplicate(self, key: str, fingerprint: int) -> Optional[str]:
+        for band, band_key in zip(self.bands, self._band_keys(fingerprint)):
+            for candidate in sorted(band.get(band_key, ())):
+                if candidate == key:
+                    continue
+                if bin(self.fingerprints[candidate] ^ fingerprint).count('1') <= self.max_distance:
+                    return candidate
+        return None
+
+    def check(self, key: str, html: str) -> Optional[str]:
+        """
+        Look a chapter up in the index and add it when it is not a near-duplicate
+        :param key: chapter identity, unique within the book (chapter names repeat across volumes)
+        :param html: chapter content, tags are ignored
+        :return: key of the chapter it duplicates, None if it is new or too short to judge
+        """
+        text = self.clean_text(html)
+        if len(text) < self.min_length:
+            return None
+        fingerprint = self.simhash(text)
+        with self.lock:
+            duplicate = self.find_duplicate(key, fingerprint)
+            if duplicate is None:
+                if key in self.fingerprints:
+                    self._remove(key)
+                self._add(key, fingerprint)
+        return duplicate
+
+    def _remove(self, key: str):
+        fingerprint = self.fingerprints.pop(key)
+        for band, band_key in zip(self.bands, self._band_keys(fingerprint)):
+            band[band_key].discard(key)
+
+    def save(self) -> 'FingerprintIndex':
+        if self.index_file is None:
+            return self
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            with open(self.index_file, 'w', encoding='utf-8') as f:
+                json.dump({key: f'{fingerprint:016x}' for key, fingerprint in self.fingerprints.items()}, f,
+                          indent=4, ensure_ascii=False)
+        return self
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import urlparse
+
+import fetch
+
+# per cached file, shared by every ImageCache so that jobs of the service using the same cache
+# directory never write the same .part file at once
+download_locks: dict[pathlib.Path, threading.Lock] = {}
+download_locks_lock = threading.Lock()
+
+
+class ImageCache:
+    """
+    Local image cache filled by a background prefetcher while the crawl is still running.
+    Interrupted downloads are resumed with Range requests, and copies older than max_age
+    are revalidated with conditional requests instead of being downloaded again.
+    """
+
+    name: str = "Image Cache"
+
+    image_suffixes = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.svg'}
+
+    def __str__(self):
+        return f"[{self.name}]"
+
+    def __init__(self, cache_path: pathlib.Path = pathlib.Path('cache') / 'images', headers: Optional[dict] = None,
+                 proxy: Optional[dict] = None, max_workers: int = 4, max_age: Optional[float] = None):
+        """
+        :param max_age: seconds a cached image is used without revalidation, None to never revalidate
+        """
+        self.cache_path = cache_path
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        self.headers = headers if headers is not None else {}
+        self.proxy = proxy
+        self.max_age = max_age
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image-prefetch')
+        self.pending: dict[str, Future] = {}
+        self.lock = threading.Lock()
+
+    def path_for(self, url: str) -> pathlib.Path:
+        suffix = pathlib.PurePosixPath(urlparse(url).path).suffix.lower()
+        if suffix not in self.image_suffixes:
+            suffix = ''
+        return self.cache_path / (hashlib.sha1(url.encode('utf-8')).hexdigest() + suffix)
+
+    def is_fresh(self, path: pathlib.Path) -> bool:
+        if not path.exists():
+            return False
+        return self.max_age is None or time.time() - path.stat().st_mtime < self.max_age
+
+    @classmethod
+    def validators_path(cls, path: pathlib.Path) -> pathlib.Path:
+        return path.with_name(path.name + '.meta.json')
+
+    def read_validators(self, path: pathlib.Path) -> dict:
+        validators_path = self.validators_path(path)
+        if not validators_path.exists():
+            return {}
+        with open(validators_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_validators(self, path: pathlib.Path, headers) -> dict:
+        validators = {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+        with open(self.validators_path(path), 'w', encoding='utf-8') as f:
+            json.dump(validators, f)
+        return validators
+
+    def prefetch(self, url: Optional[str]) -> 'ImageCache':
+        """
+        Queue an image for download without blocking the caller
+        :param url:
+        :return:
+        """
+        if url is None:
+            return self
+        url = url.strip()
+        if not url.startswith('http'):
+            return self
+        with self.lock:
+            if url in self.pending or self.is_fresh(self.path_for(url)):
+                return self
+            self.pending[url] = self.executor.submit(self._download, url)
+        return self
+
+    def get(self, url: str) -> Optional[bytes]:
+        """
+        Read an image from the cache, waiting for a queued download or fetching it now if it was never queued
+        :param url:
+        :return: image bytes, None if the image could not be downloaded
+        """
+        url = url.strip()
+        with self.lock:
+            future = self.pending.get(url)
+        if future is not None:
+            future.result()
+        path = self.path_for(url)
+        if not self.is_fresh(path):
+            self._download(url)
+        if path.exists():
+            return path.read_bytes()
+        return None
+
+    def wait(self) -> 'ImageCache':
+        with self.lock:
+            futures = list(self.pending.values())
+        for future in futures:
+            future.result()
+        return self
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def _download(self, url: str) -> bool:
+        path = self.path_for(url)
+        with download_locks_lock:
+            download_lock = download_locks.setdefault(path.resolve(), threading.Lock())
+        with download_lock:
+            if self.is_fresh(path):
+                return True
+            return self._transfer(url, path)
+
+    def _transfer(self, url: str, path: pathlib.Path) -> bool:
+        """
+        Revalidate a stale copy, resume a partial download or download the image from scratch
+        :param url:
+        :param path:
+        :return: True if the cache holds a current copy afterwards
+        """
+        part_path = path.with_name(path.name + '.part')
+        validators = self.read_validators(path)
+        validator = validators.get('etag') or validators.get('last_modified')
+        headers = dict(self.headers)
+        offset = 0
+        if path.exists():
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        elif part_path.exists() and validator:
+            offset = part_path.stat().st_size
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = validator
+        part_file = None
+        resumable = True
+
+        def open_part(r):
+            nonlocal part_file, resumable
+            # Range offsets count bytes on the wire, they only match the .part file for an unencoded body
+            resumable = r.headers.get('Content-Encoding', 'identity').lower() == 'identity'
+            if r.status_code == 206:
+                if not resumable:
+                    raise ValueError(f'encoded partial response ({r.headers.get("Content-Encoding")})')
+                if not r.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                    raise ValueError(f'unexpected Content-Range {r.headers.get("Content-Range")}')
+                part_file = open(part_path, 'ab')
+            elif r.status_code == 200:
+                part_file = open(part_path, 'wb')
+            else:
+                return None
+            self.save_validators(path, r.headers)
+            return part_file
+
+        try:
+            r = fetch.fetch(url, headers=headers, proxies=self.proxy, sink=open_part, page=False, encoding='identity')
+            if r.status_code == 304:
+                os.utime(path)
+                return True
+            r.raise_for_status()
+        except Exception as e:
+            print(f'{self} 下载图片{url}时发生错误: {e}')
+            if part_file is not None:
+                part_file.close()
+                part_file = None
+            elif offset:
+                # the server refused to resume from this .part
+                part_path.unlink(missing_ok=True)
+            if not resumable:
+                part_path.unlink(missing_ok=True)
+            return False
+        finally:
+            if part_file is not None:
+                part_file.close()
+        if r.status_code == 206 and part_path.stat().st_size != offset + r.wire_bytes:
+            print(f'{self} 续传的图片{url}长度不符 ({part_path.stat().st_size} != {offset + r.wire_bytes})，已丢弃')
+            part_path.unlink(missing_ok=True)
+            return False
+        part_path.replace(path)
+        return True
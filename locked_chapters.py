@@ -0,0 +1,54 @@
+import json
+import pathlib
+import threading
+
+# shared by every cache instance, the crawlers of the job service write the same file concurrently
+file_lock = threading.Lock()
+
+
+class LockedChapterCache:
+    """
+    Persistent set of chapter urls that were found behind a paywall, so re-runs skip them without a request.
+    The file is shared by every book, writes merge with what is on disk instead of overwriting it.
+    """
+
+    def __init__(self, cache_file: pathlib.Path = pathlib.Path('cache') / 'locked_chapters.json',
+                 recheck: bool = False):
+        """
+        :param recheck: ignore the known locked chapters when checking, newly found ones are still recorded
+        """
+        self.cache_file = cache_file
+        self.recheck = recheck
+        self.locked: dict[str, str] = {}
+        with file_lock:
+            self.locked = self.read()
+
+    def read(self) -> dict[str, str]:
+        if not self.cache_file.exists():
+            return {}
+        with open(self.cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def write(self, locked: dict[str, str]):
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.cache_file.with_name(self.cache_file.name + '.tmp')
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(locked, f, indent=4, ensure_ascii=False)
+        temp_file.replace(self.cache_file)
+
+    def is_locked(self, url: str) -> bool:
+        return not self.recheck and url in self.locked
+
+    def add(self, url: str, marker: str) -> 'LockedChapterCache':
+        with file_lock:
+            self.locked = self.read()
+            self.locked[url] = marker
+            self.write(self.locked)
+        return self
+
+    def remove(self, url: str) -> 'LockedChapterCache':
+        with file_lock:
+            self.locked = self.read()
+            if self.locked.pop(url, None) is not None:
+                self.write(self.locked)
+        return self
@@ -1,21 +1,23 @@
-from engine import BaseCrawler
-from models import Section, Chapter, Book, ChapterMeta, Paragraph, ChapterType, BookMeta
+from engine import BaseCrawler, get_text_converter
+from models import Section, Chapter, Book, ChapterMeta, Paragraph, ChapterType, BookMeta, TocEntry
 import re
-from typing import Optional
+from typing import Iterator, Optional
 from bs4 import BeautifulSoup
-import opencc
 
 
 class MasiroCrawler(BaseCrawler):
+    paywall_markers = ['立即打钱']
+    text_converter_config = 't2s'
 
     def __init__(self, url: str):
         super().__init__(url)
         self.root_url = 'https://masiro.me'
-        self.text_converter = opencc.OpenCC('t2s')
+        self.book_info_page: Optional[BeautifulSoup] = None
 
-    def crawl(self):
+    def crawl_book_info(self):
         html = self._get_html(self.book_url)
-        book_info_page = BeautifulSoup(html, 'html.parser')
+        self.book_info_page = BeautifulSoup(html, 'html.parser')
+        book_info_page = self.book_info_page
         self.book.meta.title = book_info_page.find('div', class_='novel-title').text
         novel_detail = book_info_page.find('div', class_='n-detail')
         self.book.meta.author = [novel_detail.find('div', class_='author').a.string]
@@ -25,35 +27,29 @@ class MasiroCrawler(BaseCrawler):
         self.book.meta.language = 'zh-CN'
         self.book.meta.identifier = 'masiro_book_' + self.book_url.split('=')[-1]
         self.book.meta.meta = {'source': self.book_url}
-        chapter_ul = book_info_page.find('ul', class_='chapter-ul')
+        self.prefetch_cover()
+
+    def iter_toc(self) -> Iterator[TocEntry]:
+        if self.book_info_page is None:
+            self.crawl_book_info()
+        chapter_ul = self.book_info_page.find('ul', class_='chapter-ul')
         section_count: int = 0
         chapter_count: int = 0
-        current_section: Optional[Section] = None
+        section_name: str = '正文'
         for li in chapter_ul.findAll('li'):
             if li.get('class') and 'chapter-box' in li.get('class'):
-                if current_section is not None:
-                    self.book.sections.append(current_section)
-                section_name = li.b.text.strip().replace(u'\u3000', u'').replace(u'\xa0 ', u'')
+                section_name = self.text_converter.convert(li.b.text.strip().replace(u'\u3000', u'').replace(u'\xa0 ', u''))
                 section_count += 1
-                current_section = Section(section_name=section_name, section_order=section_count)
             else:
                 for chapter_a in li.findAll('a'):
-                    current_chapter = self.parse(self.root_url + chapter_a['href'])
-                    if current_chapter is None:
-                        continue
                     chapter_count += 1
-                    current_chapter.metadata.section_name = self.text_converter.convert(current_section.section_name)
-                    current_chapter.metadata.section_order = current_section.section_order
-                    current_chapter.metadata.chapter_order = chapter_count
-                    current_section.section_content.append(current_chapter)
-
-        if current_section is not None:
-            self.book.sections.append(current_section)
+                    yield TocEntry(section_name=section_name, section_order=section_count,
+                                   chapter_url=self.root_url + chapter_a['href'], chapter_order=chapter_count)
 
     def parse(self, chapter_url: str) -> Optional[Chapter]:
         chapter = Chapter()
-        html = self._get_html(chapter_url)
-        if '立即打钱' in html:
+        html = self._get_chapter_html(chapter_url)
+        if html is None:
             return None
         chapter_page = BeautifulSoup(html, 'html.parser')
         chapter.metadata.chapter_name = self.text_converter.convert(chapter_page.find('span', class_='novel-title').div.text.strip().replace(u'\u3000', u'').replace(u'\xa0 ', u''))
@@ -62,6 +58,7 @@ class MasiroCrawler(BaseCrawler):
         content_box = chapter_page.find('div', class_='nvl-content')
         # for paragraph in content_box.findAll('p'):
         chapter.paragraphs.append(Paragraph(type=Paragraph.ParagraphType.HTML, content=self.process_text(content_box.prettify())))
+        self.prefetch_images(chapter)
         print("Parsed chapter: " + chapter.metadata.chapter_name)
         return chapter
 
@@ -76,7 +73,7 @@ class MasiroCrawler(BaseCrawler):
         text = re.sub(r'\(受丘.*?\)', '', text)
         text = text.replace('color: #444444;', '')
         text = text.replace('background-color: #ffffff;', '')
-        converter = opencc.OpenCC('t2s')
+        converter = get_text_converter('t2s')
         text = converter.convert(text)
         return text
 
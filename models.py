@@ -12,6 +12,7 @@ class BookMeta(BaseModel):
     cover: Optional[str] = None
     publisher: Optional[str] = None
     identifier: Optional[str] = None
+    modified: Optional[str] = None  # ISO 8601, dcterms:modified and ZIP timestamps of the EPUB
 
 
 class ChapterType(enum.Enum):
@@ -54,6 +55,15 @@ class Section(BaseModel):
     section_content: list[Chapter] = []
 
 
+class TocEntry(BaseModel):
+    section_name: str
+    section_order: int
+    chapter_url: str
+    chapter_order: int
+    chapter_name: Optional[str] = None
+    locked: bool = False
+
+
 class Book(BaseModel):
     meta: BookMeta = BookMeta()
     sections: list[Section] = []
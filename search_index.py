@@ -0,0 +1,176 @@
+import hashlib
+import html
+import json
+import pathlib
+import re
+import sqlite3
+import threading
+from typing import Optional
+
+# kana, CJK ideographs (extension A, unified, compatibility) and hangul
+CJK_RANGES = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+
+
+class SearchIndex:
+    """
+    Incremental full-text index over crawled Markdown output, backed by SQLite FTS5.
+    CJK runs are indexed as overlapping bigrams (plus the last character of the run),
+    everything else as lower-cased words, so the default FTS5 tokenizer only splits on spaces.
+    """
+
+    token_pattern = re.compile(f'([{CJK_RANGES}]+)|([^\\W_{CJK_RANGES}]+)')
+    tag_pattern = re.compile(r'<[^>]+>')
+    image_pattern = re.compile(r'!\[[^\]]*\]\([^)]*\)')
+    fields = ('title', 'author', 'body')
+
+    def __init__(self, index_path: pathlib.Path = pathlib.Path('cache') / 'search.db'):
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(index_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS books (
+                    identifier TEXT PRIMARY KEY, title TEXT, author TEXT, description TEXT, path TEXT
+                );
+                CREATE TABLE IF NOT EXISTS chapters (
+                    id INTEGER PRIMARY KEY, identifier TEXT, chapter_name TEXT, section_name TEXT,
+                    chapter_order INTEGER, file_name TEXT, digest TEXT, UNIQUE (identifier, chapter_name)
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(title, author, description);
+                CREATE VIRTUAL TABLE IF NOT EXISTS chapters_fts USING fts5(chapter_name, body);
+            ''')
+
+    @classmethod
+    def tokenize(cls, text: str) -> list[str]:
+        tokens = []
+        for cjk, word in cls.token_pattern.findall(text):
+            if word:
+                tokens.append(word.lower())
+                continue
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+            tokens.append(cjk[-1])
+        return tokens
+
+    @classmethod
+    def parse_front_matter(cls, md: str) -> tuple[dict[str, str], str]:
+        if not md.startswith('---\n'):
+            return {}, md
+        end = md.find('\n---\n', 4)
+        if end == -1:
+            return {}, md
+        metadata = {}
+        for line in md[4:end].splitlines():
+            key, _, value = line.partition(':')
+            metadata[key.strip()] = value.strip()
+        return metadata, md[end + 5:]
+
+    @classmethod
+    def clean_body(cls, md: str) -> str:
+        return html.unescape(cls.tag_pattern.sub(' ', cls.image_pattern.sub(' ', md)))
+
+    def index_book(self, book_path: pathlib.Path) -> int:
+        """
+        Index the output directory of one crawl, only new or changed chapters are tokenized
+        :param book_path: directory holding book_meta.json and the chapter Markdown files
+        :return: number of chapters (re)indexed, rows of chapters no longer on disk are removed
+        """
+        with open(book_path / 'book_meta.json', 'r', encoding='utf-8') as f:
+            book_meta = json.load(f)
+        identifier = book_meta.get('identifier') or book_meta.get('title') or str(book_path)
+        author = ' '.join(book_meta.get('author') or [])
+        indexed = 0
+        chapter_ids = set()
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT rowid FROM books WHERE identifier = ?', (identifier,)).fetchone()
+            if row is not None:
+                self.connection.execute('DELETE FROM books_fts WHERE rowid = ?', (row[0],))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO books (identifier, title, author, description, path) VALUES (?, ?, ?, ?, ?)',
+                (identifier, book_meta.get('title'), author, book_meta.get('description'), str(book_path)))
+            book_rowid = self.connection.execute('SELECT rowid FROM books WHERE identifier = ?', (identifier,)).fetchone()[0]
+            self.connection.execute(
+                'INSERT INTO books_fts (rowid, title, author, description) VALUES (?, ?, ?, ?)',
+                (book_rowid, ' '.join(self.tokenize(book_meta.get('title') or '')), ' '.join(self.tokenize(author)),
+                 ' '.join(self.tokenize(book_meta.get('description') or ''))))
+            for chapter_path in sorted(book_path.glob('*.md')):
+                md = chapter_path.read_text(encoding='utf-8')
+                digest = hashlib.sha1(md.encode('utf-8')).hexdigest()
+                metadata, body = self.parse_front_matter(md)
+                chapter_name = metadata.get('chapter_name') or chapter_path.stem
+                row = self.connection.execute('SELECT id, digest FROM chapters WHERE identifier = ? AND chapter_name = ?',
+                                              (identifier, chapter_name)).fetchone()
+                if row is not None and row[1] == digest:
+                    self.connection.execute('UPDATE chapters SET file_name = ? WHERE id = ?', (chapter_path.name, row[0]))
+                    chapter_ids.add(row[0])
+                    continue
+                if row is not None:
+                    self.connection.execute('DELETE FROM chapters_fts WHERE rowid = ?', (row[0],))
+                    self.connection.execute('DELETE FROM chapters WHERE id = ?', (row[0],))
+                chapter_order = metadata.get('chapter_order')
+                cursor = self.connection.execute(
+                    'INSERT INTO chapters (identifier, chapter_name, section_name, chapter_order, file_name, digest) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (identifier, chapter_name, metadata.get('section_name'),
+                     int(chapter_order) if chapter_order and chapter_order.isdigit() else None, chapter_path.name, digest))
+                self.connection.execute('INSERT INTO chapters_fts (rowid, chapter_name, body) VALUES (?, ?, ?)',
+                                        (cursor.lastrowid, ' '.join(self.tokenize(chapter_name)),
+                                         ' '.join(self.tokenize(self.clean_body(body)))))
+                chapter_ids.add(cursor.lastrowid)
+                indexed += 1
+            stale_ids = [chapter_id for chapter_id, in self.connection.execute(
+                'SELECT id FROM chapters WHERE identifier = ?', (identifier,)) if chapter_id not in chapter_ids]
+            self.connection.executemany('DELETE FROM chapters_fts WHERE rowid = ?', ((i,) for i in stale_ids))
+            self.connection.executemany('DELETE FROM chapters WHERE id = ?', ((i,) for i in stale_ids))
+        return indexed
+
+    @classmethod
+    def build_query(cls, query: str) -> Optional[str]:
+        phrases = []
+        for term in query.split():
+            tokens = cls.tokenize(term)
+            if not tokens:
+                continue
+            if len(tokens) > 1 and tokens[-2].endswith(tokens[-1]):
+                tokens = tokens[:-1]
+            phrase = '"' + ' '.join(tokens) + '"'
+            if cls.token_pattern.fullmatch(tokens[-1]).group(1) and len(tokens[-1]) == 1:
+                phrase += '*'
+            phrases.append(phrase)
+        if not phrases:
+            return None
+        return ' AND '.join(phrases)
+
+    def search(self, query: str, field: Optional[str] = None, limit: int = 20) -> list[dict]:
+        """
+        Search books by title or author and chapters by body text
+        :param query: space separated terms, all of them must match
+        :param field: 'title', 'author' or 'body', None searches all of them
+        :param limit:
+        :return: matches ordered by relevance, book matches first
+        """
+        if field is not None and field not in self.fields:
+            raise ValueError(f'Unknown field {field}')
+        match = self.build_query(query)
+        if match is None:
+            return []
+        results = []
+        with self.lock:
+            if field in (None, 'title', 'author'):
+                columns = '{title author}' if field is None else field
+                for identifier, title, author in self.connection.execute(
+                        'SELECT books.identifier, books.title, books.author FROM books_fts '
+                        'JOIN books ON books.rowid = books_fts.rowid WHERE books_fts MATCH ? ORDER BY rank LIMIT ?',
+                        (f'{columns} : ({match})', limit)):
+                    results.append({'identifier': identifier, 'title': title, 'author': author})
+            if field in (None, 'body'):
+                for identifier, title, chapter_name, file_name in self.connection.execute(
+                        'SELECT chapters.identifier, books.title, chapters.chapter_name, chapters.file_name '
+                        'FROM chapters_fts JOIN chapters ON chapters.id = chapters_fts.rowid '
+                        'JOIN books ON books.identifier = chapters.identifier '
+                        'WHERE chapters_fts MATCH ? ORDER BY rank LIMIT ?', (f'body : ({match})', limit)):
+                    results.append({'identifier': identifier, 'title': title, 'chapter_name': chapter_name,
+                                    'file_name': file_name})
+        return results[:limit]
+
+    def close(self):
+        self.connection.close()
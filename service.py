@@ -0,0 +1,318 @@
+"""
+Long-running crawl service with a local HTTP API.
+
+    python cli.py serve [--host 127.0.0.1] [--port 8000] [--workers 2]
+
+    POST /jobs                 {"site": "sfacg", "url": "...", "formats": ["epub"]}
+                               {"type": "export", "path": "output", "formats": ["txt", "volumes"]}
+    GET  /jobs                 all jobs
+    GET  /jobs/<id>            state of one job
+    GET  /jobs/<id>/events     per-chapter progress as server-sent events
+    GET  /metrics              per-host fetch statistics
+
+Jobs run on a shared worker pool in this process, so OpenCC dictionaries, the per-host
+concurrency limits and the image / paywall caches stay warm across jobs.
+"""
+import json
+import pathlib
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse
+
+from pydantic import BaseModel, ValidationError
+
+import fetch
+from cli import EXPORT_FORMATS, SITES, load_crawler_class
+
+
+class JobRequest(BaseModel):
+    type: str = 'crawl'  # 'crawl' or 'export'
+    site: Optional[str] = None
+    url: Optional[str] = None
+    adapter: Optional[str] = None  # site config of 'universal'
+    cover: Optional[str] = None
+    path: Optional[str] = None  # markdown directory of an 'export' job
+    formats: list[str] = ['epub']
+    max_part_size: int = 20  # MB
+
+    def check(self) -> 'JobRequest':
+        if self.type == 'crawl':
+            if self.site not in SITES:
+                raise ValueError(f'Unknown site {self.site}')
+            if not self.url:
+                raise ValueError('url is required')
+            formats = ['markdown', *EXPORT_FORMATS]
+        elif self.type == 'export':
+            if not self.path or not pathlib.Path(self.path).is_dir():
+                raise ValueError(f'{self.path} is not a directory')
+            formats = EXPORT_FORMATS
+        else:
+            raise ValueError(f'Unknown job type {self.type}')
+        for job_format in self.formats:
+            if job_format not in formats:
+                raise ValueError(f'Unknown format {job_format}')
+        return self
+
+
+class Job(BaseModel):
+    id: str
+    request: JobRequest
+    status: str = 'queued'  # queued, running, done, failed
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    title: Optional[str] = None
+    chapters_done: int = 0
+    chapters_skipped: int = 0
+    outputs: list[str] = []
+    error: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+
+class JobManager:
+    """
+    Runs jobs on a shared thread pool. Job state is persisted to jobs/<id>.json and the progress
+    events to jobs/<id>/events.jsonl, unfinished jobs are queued again when the service restarts.
+    """
+
+    def __str__(self):
+        return f'[{self.name}]'
+
+    name: str = "Job Manager"
+
+    def __init__(self, jobs_path: pathlib.Path = pathlib.Path('jobs'), max_workers: int = 2,
+                 save_interval: float = 1):
+        self.jobs_path = jobs_path
+        self.jobs_path.mkdir(parents=True, exist_ok=True)
+        self.save_interval = save_interval
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.jobs: dict[str, Job] = {}
+        self.events: dict[str, list[dict]] = {}
+        self.saved_at: dict[str, float] = {}
+        self.condition = threading.Condition()
+        self.load()
+
+    def load(self):
+        for job_file in sorted(self.jobs_path.glob('*.json'), key=lambda path: path.stat().st_mtime):
+            with open(job_file, 'r', encoding='utf-8') as f:
+                job = Job(**json.load(f))
+            self.jobs[job.id] = job
+            self.events[job.id] = []
+            events_file = self.jobs_path / job.id / 'events.jsonl'
+            if events_file.exists():
+                with open(events_file, 'r', encoding='utf-8') as f:
+                    self.events[job.id] = [json.loads(line) for line in f if line.strip()]
+            if not job.finished:
+                print(f'{self} 重新排队未完成的任务 {job.id}')
+                job.status = 'queued'
+                job.chapters_done = job.chapters_skipped = 0
+                self.executor.submit(self.run, job)
+
+    def submit(self, request: JobRequest) -> Job:
+        job = Job(id=uuid.uuid4().hex[:12], request=request.check(), created_at=time.time())
+        with self.condition:
+            self.jobs[job.id] = job
+            self.events[job.id] = []
+        self.emit(job, 'status', status=job.status)
+        self.executor.submit(self.run, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def all_jobs(self) -> list[Job]:
+        return sorted(self.jobs.values(), key=lambda job: job.created_at)
+
+    def emit(self, job: Job, event: str, **data):
+        """
+        Record a progress event and wake up the event streams of the job
+        """
+        with self.condition:
+            if event == 'status':
+                job.status = data['status']
+                if job.status == 'running':
+                    job.started_at = time.time()
+                elif job.finished:
+                    job.finished_at = time.time()
+            elif event == 'book_info':
+                job.title = data.get('title')
+            elif event == 'chapter':
+                if data.get('skipped'):
+                    job.chapters_skipped += 1
+                else:
+                    job.chapters_done += 1
+            record = {'id': len(self.events[job.id]), 'event': event, 'time': time.time(), 'data': data}
+            self.events[job.id].append(record)
+            self.condition.notify_all()
+            events_file = self.jobs_path / job.id / 'events.jsonl'
+            events_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(events_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            if event == 'status' or time.time() - self.saved_at.get(job.id, 0) > self.save_interval:
+                self.save(job)
+
+    def wait_events(self, job_id: str, start: int, timeout: float = 15) -> tuple[list[dict], bool]:
+        """
+        Block until the job has events after `start` or finishes
+        :param job_id:
+        :param start: index of the first event wanted
+        :param timeout: seconds to wait before returning an empty list
+        :return: new events and whether the stream is complete
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.events[job_id]) > start or self.jobs[job_id].finished, timeout)
+            events = self.events[job_id][start:]
+            return events, self.jobs[job_id].finished
+
+    def save(self, job: Job):
+        with self.condition:
+            temp_file = self.jobs_path / f'{job.id}.json.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(job.dict(), f, indent=4, ensure_ascii=False)
+            temp_file.replace(self.jobs_path / f'{job.id}.json')
+            self.saved_at[job.id] = time.time()
+
+    def set_status(self, job: Job, status: str, **data):
+        self.emit(job, 'status', status=status, **data)
+
+    def run(self, job: Job):
+        self.set_status(job, 'running')
+        try:
+            if job.request.type == 'crawl':
+                outputs = self.run_crawl(job)
+            else:
+                outputs = self.run_export(job)
+        except Exception as e:
+            traceback.print_exc()
+            job.error = f'{e.__class__.__name__}: {e}'
+            self.set_status(job, 'failed', error=job.error)
+            return
+        job.outputs = [str(output) for output in outputs]
+        self.set_status(job, 'done', outputs=job.outputs)
+
+    def run_crawl(self, job: Job) -> list[pathlib.Path]:
+        request = job.request
+        crawler_class = load_crawler_class(request.site)
+        # a job must never wait on the server's stdin, missing values fail the job instead
+        if request.adapter is not None:
+            crawler = crawler_class(request.adapter, request.url, interactive=False)
+        elif request.site == 'universal':
+            crawler = crawler_class(request.url, interactive=False)
+        else:
+            crawler = crawler_class(request.url).set_interactive(False)
+        if request.cover is not None:
+            crawler.set_cover(request.cover)
+        crawler.add_progress_callback(lambda event, data: self.emit(job, event, **data))
+        formats = [job_format for job_format in request.formats if job_format != 'markdown']
+        crawler.set_image_prefetch(bool(formats))
+        job_path = self.jobs_path / job.id
+        md_path = job_path / 'markdown'
+        md_path.mkdir(parents=True, exist_ok=True)
+        crawler.set_save_path(md_path)
+        try:
+            crawler.run()
+            if not formats:
+                crawler.save_as_markdown()
+                return [md_path]
+            return crawler.export(formats, job_path, request.max_part_size * 1024 * 1024)
+        finally:
+            crawler.image_cache.shutdown()
+
+    def run_export(self, job: Job) -> list[pathlib.Path]:
+        from exporter import BookExporter
+        request = job.request
+        exporter = BookExporter().set_md_path(pathlib.Path(request.path)).prepare()
+        return exporter.export(self.jobs_path / job.id, request.formats, request.max_part_size * 1024 * 1024)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    manager: JobManager
+
+    def do_GET(self):
+        parts = [part for part in urlparse(self.path).path.split('/') if part]
+        if parts == ['jobs']:
+            return self.send_json([job.dict() for job in self.manager.all_jobs()])
+        if parts == ['metrics']:
+            return self.send_json(fetch.controller.metrics())
+        if len(parts) in (2, 3) and parts[0] == 'jobs':
+            job = self.manager.get(parts[1])
+            if job is None:
+                return self.send_json({'error': f'Unknown job {parts[1]}'}, HTTPStatus.NOT_FOUND)
+            if len(parts) == 2:
+                return self.send_json(job.dict())
+            if parts[2] == 'events':
+                return self.stream_events(job)
+        self.send_json({'error': 'Not found'}, HTTPStatus.NOT_FOUND)
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != '/jobs':
+            return self.send_json({'error': 'Not found'}, HTTPStatus.NOT_FOUND)
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            job = self.manager.submit(JobRequest(**json.loads(body or b'{}')))
+        except (ValueError, ValidationError) as e:
+            return self.send_json({'error': str(e)}, HTTPStatus.BAD_REQUEST)
+        self.send_json(job.dict(), HTTPStatus.CREATED)
+
+    def send_json(self, data, status: HTTPStatus = HTTPStatus.OK):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_events(self, job: Job):
+        """
+        Server-sent events of a job, replayed from the start (or after Last-Event-ID) and closed once the job finishes
+        """
+        try:
+            start = int(self.headers.get('Last-Event-ID', -1)) + 1
+        except ValueError:
+            return self.send_json({'error': 'Last-Event-ID must be an event id'}, HTTPStatus.BAD_REQUEST)
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while True:
+                events, finished = self.manager.wait_events(job.id, start)
+                if not events and not finished:
+                    self.wfile.write(b': keep-alive\n\n')
+                for record in events:
+                    self.wfile.write(f'id: {record["id"]}\nevent: {record["event"]}\n'
+                                     f'data: {json.dumps(record["data"], ensure_ascii=False)}\n\n'.encode('utf-8'))
+                start += len(events)
+                self.wfile.flush()
+                if finished and not events:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def serve(host: str = '127.0.0.1', port: int = 8000, max_workers: int = 2,
+          jobs_path: pathlib.Path = pathlib.Path('jobs')):
+    manager = JobManager(jobs_path, max_workers)
+    handler = type('BoundJobRequestHandler', (JobRequestHandler,), {'manager': manager})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    print(f'{manager} 服务已启动: http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        manager.shutdown()
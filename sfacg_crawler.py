@@ -1,19 +1,19 @@
-from engine import BaseCrawler
-from models import Section, Chapter, Book, ChapterMeta, Paragraph, ChapterType, BookMeta
+from engine import BaseCrawler, get_text_converter, prompt
+from models import Section, Chapter, Book, ChapterMeta, Paragraph, ChapterType, BookMeta, TocEntry
 import re
-from typing import Optional
+from typing import Iterator, Optional
 from bs4 import BeautifulSoup
-import opencc
 
 
 class SfAcgCrawler(BaseCrawler):
+    paywall_markers = ['付费阅读']
+    text_converter_config = 't2s'
 
     def __init__(self, url: str):
         super().__init__(url)
         self.root_url = 'https://book.sfacg.com'
-        self.text_converter = opencc.OpenCC('t2s')
 
-    def crawl(self):
+    def crawl_book_info(self):
         html = self._get_html(self.book_url)
         book_info_page = BeautifulSoup(html, 'html.parser')
         self.book.meta.title = book_info_page.find('h1', class_='title').findChild('span', class_='text').text
@@ -21,12 +21,15 @@ class SfAcgCrawler(BaseCrawler):
         try:
             self.book.meta.cover = book_info_page.find('div', class_='summary-pic').img.attrs['src']
         except AttributeError:
-            self.book.meta.cover = input('Please input the cover url: ')
+            self.book.meta.cover = prompt('Please input the cover url: ', self.interactive)
         self.book.meta.description = book_info_page.find('p', class_='introduce').text
         self.book.meta.publisher = 'Sfacg'
         self.book.meta.language = 'zh-CN'
         self.book.meta.identifier = 'sf_book_' + self.book_url.split('/')[-1]
         self.book.meta.meta = {'source': self.book_url}
+        self.prefetch_cover()
+
+    def iter_toc(self) -> Iterator[TocEntry]:
         chapter_page_html = self._get_html(self.book_url + '/MainIndex/')
         chapter_page = BeautifulSoup(chapter_page_html, 'html.parser')
         chapter_list = chapter_page.findAll('div', class_='story-catalog')
@@ -34,25 +37,17 @@ class SfAcgCrawler(BaseCrawler):
         chapter_count: int = 0
         for li in chapter_list:
             section_count += 1
-            section_name = li.findChild('div', class_='catalog-hd').h3.text.split('】')[-1].strip()
-            current_section = Section(section_name=section_name, section_order=section_count)
+            section_name = self.text_converter.convert(li.findChild('div', class_='catalog-hd').h3.text.split('】')[-1].strip())
             for chapter_a in li.findAll('li'):
-                if chapter_a.a.span is not None and chapter_a.a.span.text == 'VIP':
-                    continue
-                current_chapter = self.parse(self.root_url + chapter_a.a['href'])
-                if current_chapter is None:
-                    continue
                 chapter_count += 1
-                current_chapter.metadata.section_name = self.text_converter.convert(current_section.section_name)
-                current_chapter.metadata.section_order = current_section.section_order
-                current_chapter.metadata.chapter_order = chapter_count
-                current_section.section_content.append(current_chapter)
-            self.book.sections.append(current_section)
+                yield TocEntry(section_name=section_name, section_order=section_count,
+                               chapter_url=self.root_url + chapter_a.a['href'], chapter_order=chapter_count,
+                               locked=chapter_a.a.span is not None and chapter_a.a.span.text == 'VIP')
 
     def parse(self, chapter_url: str) -> Optional[Chapter]:
         chapter = Chapter()
-        html = self._get_html(chapter_url)
-        if '付费阅读' in html:
+        html = self._get_chapter_html(chapter_url)
+        if html is None:
             print('Chapter is not free content, skip')
             return None
         chapter_page = BeautifulSoup(html, 'html.parser')
@@ -63,6 +58,7 @@ class SfAcgCrawler(BaseCrawler):
         content_box = chapter_page.find('div', class_='article-content')
         # for paragraph in content_box.findAll('p'):
         chapter.paragraphs.append(Paragraph(type=Paragraph.ParagraphType.HTML, content=self.process_text(content_box.prettify())))
+        self.prefetch_images(chapter)
         print("Parsed chapter: " + chapter.metadata.chapter_name)
         return chapter
 
@@ -75,7 +71,7 @@ class SfAcgCrawler(BaseCrawler):
         """
         text = text.replace('color: #444444;', '')
         text = text.replace('background-color: #ffffff;', '')
-        converter = opencc.OpenCC('t2s')
+        converter = get_text_converter('t2s')
         text = converter.convert(text)
         return text
 
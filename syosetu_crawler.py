@@ -1,7 +1,8 @@
 from engine import BaseCrawler
-from models import Section, Chapter, Book, ChapterMeta, Paragraph, ChapterType, BookMeta
+from models import Section, Chapter, Book, ChapterMeta, Paragraph, ChapterType, BookMeta, TocEntry
 import re
-from typing import Optional
+from typing import Iterator, Optional
+from urllib.parse import urljoin
 from bs4 import BeautifulSoup
 from bs4.element import NavigableString
 
@@ -12,52 +13,74 @@ class SyosetuCrawler(BaseCrawler):
         super().__init__(url)
         self.root_url = 'https://ncode.syosetu.com/'
         self.cover_url = ''
+        self.book_info_page: Optional[BeautifulSoup] = None
 
-    def crawl(self):
+    def crawl_book_info(self):
         html = self._get_html(self.book_url)
-        book_info_page = BeautifulSoup(html, 'html.parser')
-        self.book.meta.title = book_info_page.find('p', class_='novel_title').text
-        self.book.meta.author = [book_info_page.find('div', class_='novel_writername').a.string]
+        self.book_info_page = BeautifulSoup(html, 'html.parser')
+        book_info_page = self.book_info_page
+        title = book_info_page.find('p', class_='novel_title') or book_info_page.find('h1', class_='p-novel__title')
+        self.book.meta.title = title.text
+        writer = book_info_page.find('div', class_='novel_writername') or book_info_page.find('div', class_='p-novel__author')
+        self.book.meta.author = [writer.a.string]
         self.book.meta.cover = self.cover_url
-        self.book.meta.description = book_info_page.find(id='novel_ex').text.replace('<br>', '\n')
+        description = book_info_page.find(id='novel_ex') or book_info_page.find('div', class_='p-novel__summary')
+        self.book.meta.description = description.text.replace('<br>', '\n')
         self.book.meta.publisher = 'Syosetu'
         self.book.meta.language = 'ja-JP'
         self.book.meta.identifier = 'syosetu_book_' + self.book_url.replace(self.root_url, '').replace('/', '')
         self.book.meta.meta = {'source': self.book_url}
-        chapter_ul = book_info_page.find('div', class_='index_box')
+        self.prefetch_cover()
+
+    def iter_toc(self) -> Iterator[TocEntry]:
+        if self.book_info_page is None:
+            self.crawl_book_info()
+        toc_page: Optional[BeautifulSoup] = self.book_info_page
         section_count: int = 0
         chapter_count: int = 0
-        current_section: Optional[Section] = Section(section_name="正文", section_order=section_count)
-        for li in chapter_ul:
-            if isinstance(li, NavigableString):
-                continue
-            if li.name == 'div':
-                if current_section is not None:
-                    self.book.sections.append(current_section)
-                section_name = li.text.strip().replace(u'\u3000', u'').replace(u'\xa0 ', u'')
-                section_count += 1
-                current_section = Section(section_name=section_name, section_order=section_count)
-            else:
+        section_name: str = "正文"
+        while toc_page is not None:
+            chapter_ul = toc_page.find('div', class_='index_box') or toc_page.find('div', class_='p-eplist')
+            if chapter_ul is None:
+                break
+            for li in chapter_ul:
+                if isinstance(li, NavigableString):
+                    continue
+                if li.name == 'div' and 'p-eplist__sublist' not in li.get('class', []):
+                    section_name = li.text.strip().replace(u'\u3000', u'').replace(u'\xa0 ', u'')
+                    section_count += 1
+                    continue
+                chapter_a = li.find('a')
+                if chapter_a is None:
+                    continue
                 chapter_count += 1
-                current_chapter = self.parse(self.root_url + li.dd.a['href'])
-                current_chapter.metadata.section_name = current_section.section_name
-                current_chapter.metadata.section_order = current_section.section_order
-                current_chapter.metadata.chapter_order = chapter_count
-                current_section.section_content.append(current_chapter)
+                yield TocEntry(section_name=section_name, section_order=section_count,
+                               chapter_url=urljoin(self.root_url, chapter_a['href']), chapter_order=chapter_count)
+            toc_page = self.next_toc_page(toc_page)
 
-        if current_section is not None:
-            self.book.sections.append(current_section)
-        a = 1
+    def next_toc_page(self, toc_page: BeautifulSoup) -> Optional[BeautifulSoup]:
+        """
+        Follow the pager of a paginated index (?p=2, ?p=3, ...)
+        :param toc_page:
+        :return: the next index page, None on the last one
+        """
+        next_a = toc_page.find('a', class_='c-pager__item--next') or toc_page.find('a', class_='novelview_pager-next')
+        if next_a is None or not next_a.get('href'):
+            return None
+        return BeautifulSoup(self._get_html(urljoin(self.book_url, next_a['href'])), 'html.parser')
 
     def parse(self, chapter_url: str) -> Chapter:
         chapter = Chapter()
         html = self._get_html(chapter_url)
         chapter_page = BeautifulSoup(html, 'html.parser')
-        chapter.metadata.chapter_name = self.sanitize_filename(chapter_page.find('p', class_='novel_subtitle').text.strip().replace(u'\u3000', u'').replace(u'\xa0 ', u''))
+        subtitle = chapter_page.find('p', class_='novel_subtitle') or chapter_page.find('h1', class_='p-novel__title')
+        chapter.metadata.chapter_name = self.sanitize_filename(subtitle.text.strip().replace(u'\u3000', u'').replace(u'\xa0 ', u''))
         title = Paragraph(type=Paragraph.ParagraphType.Title, content=chapter.metadata.chapter_name)
         chapter.paragraphs.append(title)
-        content_box = chapter_page.find(id='novel_honbun')
+        content_box = chapter_page.find(id='novel_honbun') or chapter_page.select_one(
+            'div.p-novel__text:not(.p-novel__text--preface):not(.p-novel__text--afterword)')
         chapter.paragraphs.append(Paragraph(type=Paragraph.ParagraphType.HTML, content=self.process_text(content_box.prettify())))
+        self.prefetch_images(chapter)
         print("Parsed chapter: " + chapter.metadata.chapter_name)
         return chapter
 
@@ -0,0 +1,48 @@
+from boilerplate import BoilerplateFilter
+
+NAV = '<div class="nav"><a href="/prev">上一章</a><a href="/index">目录</a><a href="/next">下一章</a></div>'
+AD = '<ins class="adsbygoogle" data-ad-slot="1"></ins><script>window.ads = window.ads || [];</script>'
+SEPARATOR = '<p>——————————————</p>'
+DIALOGUE = '<p>「…………嗯，我知道了。」</p>'
+CENTERED = '<p style="text-align: center;"><span>◇◇◇◇◇◇◇◇◇◇</span></p>'
+DIV_DIALOGUE = '<div>「…………嗯，我知道了。」</div>'
+
+
+def chapter(i: int) -> str:
+    return (f'<div id="content">{NAV}<p>第{i}话的开头，这是只出现一次的正文段落。</p>{DIALOGUE}{SEPARATOR}{CENTERED}'
+            f'{DIV_DIALOGUE}{AD}<p>第{i}话的结尾，同样只出现一次。</p>{SEPARATOR}{DIALOGUE}</div>')
+
+
+def strip_book(chapters: list[str], **options) -> list[str]:
+    boilerplate_filter = BoilerplateFilter(**options)
+    for html in chapters:
+        boilerplate_filter.learn([html])
+    return [boilerplate_filter.strip(html)[0] for html in chapters]
+
+
+def test_repeated_prose_and_separators_survive():
+    for html in strip_book([chapter(i) for i in range(4)]):
+        assert html.count(SEPARATOR) == 2
+        assert html.count(DIALOGUE) == 2
+        assert CENTERED in html
+        assert DIV_DIALOGUE in html
+
+
+def test_structural_boilerplate_is_removed():
+    for i, html in enumerate(strip_book([chapter(i) for i in range(4)])):
+        assert 'class="nav"' not in html
+        assert 'adsbygoogle' not in html and '<script>' not in html
+        assert f'第{i}话的开头' in html and f'第{i}话的结尾' in html
+
+
+def test_unstructured_block_only_removed_at_the_edges():
+    note = '<div>本章由某某汉化组翻译，转载请注明出处</div>'
+    edge = strip_book([f'{note}<p>正文{i}，这一段各章不同。</p>' for i in range(4)])
+    middle = strip_book([f'<p>正文{i}，这一段各章不同。</p>{note}<p>后文{i}，这一段各章不同。</p>' for i in range(4)])
+    assert all(note not in html for html in edge)
+    assert all(note in html for html in middle)
+
+
+def test_short_books_need_min_support():
+    chapters = [f'{NAV}<p>正文{i}，这一段各章不同。</p>' for i in range(2)]
+    assert strip_book(chapters, min_chapters=2) == chapters
@@ -1,117 +1,257 @@
-from engine import BaseCrawler
-from models import Section, Chapter, Book, ChapterMeta, Paragraph, ChapterType, BookMeta
-from typing import Optional
-from bs4 import BeautifulSoup
-import opencc
+from engine import BaseCrawler, prompt
+from models import Section, Chapter, Book, ChapterMeta, Paragraph, ChapterType, BookMeta, TocEntry
+from typing import Iterator, Optional
 import pathlib
 import json
+import re
+import fetch
+import charset
+from urllib.parse import urljoin
 from pydantic import BaseModel
 from lxml import etree
-from lxml.etree import ElementTree
-import requests
 
 
 class CrawlerConfig(BaseModel):
+    """
+    Declarative site adapter. Sites with a table of contents set `toc`, chapters are then crawled
+    from the TOC (concurrently with the `chapter_workers` option in `config`), otherwise the crawler
+    follows `next_page_xpath` from `crawler_start_page` to `crawler_stop_page`.
+    """
+
     class ReplaceStr(BaseModel):
         replace_str: str
         replace_to: str
 
-    book_info_page: Optional[str]
-    crawler_start_page: Optional[str]
-    crawler_stop_page: Optional[str]
-    encoding: str = 'utf-8'
+    class TocConfig(BaseModel):
+        page: Optional[str] = None  # TOC url, '{book_url}' is replaced by the book url, defaults to the book page
+        item_xpath: str  # section headers and chapter items, in document order
+        section_test: Optional[str] = None  # true for section headers, evaluated on an item
+        section_name_xpath: str = 'string(.)'
+        section_name_regex: Optional[str] = None  # the first group of the match is used as section name
+        chapter_link_xpath: str = 'descendant-or-self::a/@href'
+        locked_test: Optional[str] = None  # true for paywalled chapters, evaluated on an item
+        next_page_xpath: Optional[str] = None  # link to the next page of a paginated TOC
+        default_section: str = '正文'
+
+    book_info_page: Optional[str] = None
+    crawler_start_page: Optional[str] = None
+    crawler_stop_page: Optional[str] = None
+    encoding: str = 'auto'  # preferred encoding, falls back to detection when the page does not decode with it
     publisher: str
     root_url: str
+    language: str = 'zh-CN'
+    convert_t2s: bool = True
+    headers: dict = {}
+    config: dict = {}
     book_name_xpath: str
-    book_cover_xpath: str
+    book_cover_xpath: Optional[str] = None
     book_author_xpath: str
     book_intro_xpath: str
 
+    toc: Optional[TocConfig] = None
     chapter_title_xpath: str
     chapter_content_xpath: str
-    next_page_xpath: str
-    replace_str_list: list[ReplaceStr]
+    next_page_xpath: Optional[str] = None
+    remove_xpaths: list[str] = []  # removed from the content box, relative to it
+    paywall_markers: list[str] = []
+    replace_str_list: list[ReplaceStr] = []
+    regex_replace_list: list[ReplaceStr] = []
+
+
+class CompiledAdapter:
+    """
+    XPath objects and regexes of a CrawlerConfig, compiled once and reused for every page
+    """
+
+    def __init__(self, config: CrawlerConfig):
+        self.book_name = etree.XPath(config.book_name_xpath)
+        self.book_cover = etree.XPath(config.book_cover_xpath) if config.book_cover_xpath else None
+        self.book_author = etree.XPath(config.book_author_xpath)
+        self.book_intro = etree.XPath(config.book_intro_xpath)
+        self.chapter_title = etree.XPath(config.chapter_title_xpath)
+        self.chapter_content = etree.XPath(config.chapter_content_xpath)
+        self.next_page = etree.XPath(config.next_page_xpath) if config.next_page_xpath else None
+        self.remove = [etree.XPath(xpath) for xpath in config.remove_xpaths]
+        self.toc_items = self.section_test = self.section_name = self.section_name_regex = None
+        self.chapter_links = self.locked_test = self.toc_next_page = None
+        if config.toc is not None:
+            self.toc_items = etree.XPath(config.toc.item_xpath)
+            self.section_test = etree.XPath(f'boolean({config.toc.section_test})') if config.toc.section_test else None
+            self.section_name = etree.XPath(config.toc.section_name_xpath)
+            if config.toc.section_name_regex:
+                self.section_name_regex = re.compile(config.toc.section_name_regex)
+            self.chapter_links = etree.XPath(config.toc.chapter_link_xpath)
+            self.locked_test = etree.XPath(f'boolean({config.toc.locked_test})') if config.toc.locked_test else None
+            self.toc_next_page = etree.XPath(config.toc.next_page_xpath) if config.toc.next_page_xpath else None
+        # applied one after another, a rule sees the output of the rules before it
+        self.replacements = [(replace_str.replace_str, replace_str.replace_to) for replace_str in config.replace_str_list]
+        self.regex_replacements = [(re.compile(replace_str.replace_str), replace_str.replace_to)
+                                   for replace_str in config.regex_replace_list]
+
+    @classmethod
+    def text(cls, result) -> Optional[str]:
+        """
+        Text of the first XPath match, which may be an element, an attribute or a string
+        """
+        if isinstance(result, list):
+            if not result:
+                return None
+            result = result[0]
+        if isinstance(result, etree._Element):
+            return ''.join(result.itertext())
+        return str(result)
+
+    def replace(self, text: str) -> str:
+        for replace_str, replace_to in self.replacements:
+            text = text.replace(replace_str, replace_to)
+        for pattern, replace_to in self.regex_replacements:
+            text = pattern.sub(replace_to, text)
+        return text
 
 
 class UniversalCrawler(BaseCrawler):
 
-    def __init__(self, config_file: str):
-        self.config = self.read_config(config_file)
+    def __init__(self, config_file: str, book_url: Optional[str] = None, interactive: bool = True):
+        """
+        :param interactive: False fails on a missing page or cover url instead of prompting for it
+        """
+        self.interactive = interactive
+        self.config = self.read_config(config_file, book_url, interactive)
         super().__init__(self.config.book_info_page)
-        self.text_converter = opencc.OpenCC('t2s')
+        self.adapter = CompiledAdapter(self.config)
+        self.paywall_markers = self.config.paywall_markers
+        self.text_converter_config = 't2s' if self.config.convert_t2s else None
         self.current_page_url = self.config.crawler_start_page
 
     @classmethod
-    def read_config(self, config_file: str) -> CrawlerConfig:
+    def read_config(self, config_file: str, book_url: Optional[str] = None, interactive: bool = True) -> CrawlerConfig:
         config_file_path = pathlib.Path(config_file)
         if not config_file_path.exists():
             raise FileNotFoundError(f'Config file {config_file} not found')
-        with open(config_file_path, 'r') as f:
+        with open(config_file_path, 'r', encoding='utf-8') as f:
             config = CrawlerConfig(**json.load(f))
+        if config.toc is None and config.next_page_xpath is None:
+            raise ValueError(f'{config_file} needs either toc or next_page_xpath')
+        if book_url is not None:
+            config.book_info_page = book_url
         if config.book_info_page is None:
-            config.book_info_page = input('Please input the book info page url: ')
-        if config.crawler_start_page is None:
-            config.crawler_start_page = input('Please input the crawler start page url: ')
-        if config.crawler_stop_page is None:
-            config.crawler_stop_page = input('Please input the crawler stop page url: ')
+            config.book_info_page = prompt('Please input the book info page url: ', interactive)
+        if config.toc is None:
+            if config.crawler_start_page is None:
+                config.crawler_start_page = prompt('Please input the crawler start page url: ', interactive)
+            if config.crawler_stop_page is None:
+                config.crawler_stop_page = prompt('Please input the crawler stop page url: ', interactive)
+        # configs written before remove_xpaths existed relied on this being built in
+        if config.publisher == 'uukanshu' and not config.remove_xpaths:
+            config.remove_xpaths = ['.//ins[@class="adsbygoogle"]']
         return config
 
-    def crawl(self):
-        html = self._get_html(self.book_url)
-        soup = BeautifulSoup(html, 'html.parser')
-        book_info_page = etree.HTML(str(soup))
-        self.book.meta.title = self.process_text(book_info_page.xpath(self.config.book_name_xpath)[0].text)
-        self.book.meta.author = [self.process_text(book_info_page.xpath(self.config.book_author_xpath)[0].text)]
-        try:
-            self.book.meta.cover = book_info_page.xpath(self.config.book_cover_xpath)[0].attrib['src']
-        except IndexError:
-            self.book.meta.cover = input('Please input the cover url: ')
-        self.book.meta.description = self.process_text(book_info_page.xpath(self.config.book_intro_xpath)[0].text)
+    def parse_config(self) -> CrawlerConfig:
+        return self.config
+
+    def crawl_book_info(self):
+        book_info_page = self.to_document(self._request(self.book_url))
+        self.book.meta.title = self.process_text(self.adapter.text(self.adapter.book_name(book_info_page)).strip())
+        self.book.meta.author = [self.process_text(self.adapter.text(self.adapter.book_author(book_info_page)).strip())]
+        if self.adapter.book_cover is not None:
+            cover = self.adapter.book_cover(book_info_page)
+            if isinstance(cover, list):
+                cover = [element.get('src') if isinstance(element, etree._Element) else element for element in cover]
+                cover = [url for url in cover if url]
+            cover = self.adapter.text(cover)
+            if not cover:
+                cover = prompt('Please input the cover url: ', self.interactive)
+            self.book.meta.cover = urljoin(self.book_url, cover.strip())
+        self.book.meta.description = self.process_text(self.adapter.text(self.adapter.book_intro(book_info_page)) or '')
         self.book.meta.publisher = self.config.publisher
-        self.book.meta.language = 'zh-CN'
+        self.book.meta.language = self.config.language
         self.book.meta.identifier = self.config.publisher + '|' + self.book_url
         self.book.meta.meta = {'source': self.book_url}
-        section_count: int = 0
+        self.prefetch_cover()
+
+    def crawl(self):
+        """
+        Adapters with a TOC use the TOC-driven crawl of BaseCrawler. Otherwise the next page of a chapter is
+        only known after parsing it, so the chain is walked here
+        :return:
+        """
+        if self.config.toc is not None:
+            return super().crawl()
+        self.crawl_book_info()
+        self.report('book_info', title=self.book.meta.title, author=self.book.meta.author)
         chapter_count: int = 0
         self.current_page_url = self.config.crawler_start_page
-        current_section = Section(section_name="第一卷", section_order=section_count)
-        while True:
-            current_chapter = self.parse(self.current_page_url)
+        while self.current_page_url is not None:
+            chapter_url = self.current_page_url
+            current_chapter, current_page = self.parse_page(chapter_url)
             if current_chapter is None:
+                # the link to the next page is on the chapter page, a paywalled chapter ends the chain
+                print(f'{chapter_url} 为付费章节，无法获取下一页，停止抓取')
                 break
             chapter_count += 1
-
-            current_chapter.metadata.section_name = "第一卷"
-            current_chapter.metadata.section_order = current_section.section_order
-            current_chapter.metadata.chapter_order = chapter_count
-            current_section.section_content.append(current_chapter)
-            if self.current_page_url is None:
+            self.add_chapter(TocEntry(section_name="第一卷", section_order=0, chapter_url=chapter_url,
+                                      chapter_order=chapter_count), current_chapter)
+            if chapter_url == self.config.crawler_stop_page:
+                self.current_page_url = None
+                continue
+            next_page = self.adapter.next_page(current_page)
+            if not next_page:
+                print(f'{chapter_url} 没有下一页，停止抓取')
                 break
-        self.book.sections.append(current_section)
+            self.current_page_url = urljoin(self.config.root_url, next_page[0].attrib['href'])
+
+    def iter_toc(self) -> Iterator[TocEntry]:
+        toc = self.config.toc
+        toc_url: Optional[str] = toc.page.format(book_url=self.book_url) if toc.page else self.book_url
+        section_count: int = 0
+        chapter_count: int = 0
+        section_name: str = toc.default_section
+        while toc_url is not None:
+            toc_page = self.to_document(self._request(toc_url))
+            for item in self.adapter.toc_items(toc_page):
+                if self.adapter.section_test is not None and self.adapter.section_test(item):
+                    section_name = self.adapter.text(self.adapter.section_name(item)) or ''
+                    if self.adapter.section_name_regex is not None:
+                        match = self.adapter.section_name_regex.search(section_name)
+                        section_name = match.group(1) if match else section_name
+                    section_name = self.process_text(section_name.strip())
+                    section_count += 1
+                    continue
+                locked = self.adapter.locked_test is not None and self.adapter.locked_test(item)
+                for href in self.adapter.chapter_links(item):
+                    chapter_count += 1
+                    yield TocEntry(section_name=section_name, section_order=section_count,
+                                   chapter_url=urljoin(toc_url, str(href).strip()), chapter_order=chapter_count,
+                                   locked=locked)
+            next_page = None
+            if self.adapter.toc_next_page is not None:
+                next_page = self.adapter.text(self.adapter.toc_next_page(toc_page))
+            toc_url = urljoin(toc_url, next_page) if next_page else None
 
     def parse(self, chapter_url: str) -> Optional[Chapter]:
+        return self.parse_page(chapter_url)[0]
+
+    def parse_page(self, chapter_url: str) -> tuple[Optional[Chapter], Optional[etree._Element]]:
         chapter = Chapter()
-        current_page_html = self._get_html(chapter_url)
-        current_page_soup = BeautifulSoup(current_page_html, 'html.parser')
-        current_page = etree.HTML(str(current_page_soup))
+        r = self._get_chapter_response(chapter_url)
+        if r is None:
+            return None, None
+        current_page = self.to_document(r)
 
-        chapter_title = self.process_text(current_page.xpath(self.config.chapter_title_xpath)[0].text)
+        chapter_title = self.process_text(self.adapter.text(self.adapter.chapter_title(current_page)).strip())
         chapter.metadata.chapter_name = chapter_title
         title = Paragraph(type=Paragraph.ParagraphType.Title, content=chapter_title)
         chapter.paragraphs.append(title)
-        content_box = current_page.xpath(self.config.chapter_content_xpath)[0]
-        # for paragraph in content_box.findAll('p'):
-        if self.config.publisher == 'uukanshu':
-            for ad in content_box.xpath('//ins[@class="adsbygoogle"]'):
-                ad.getparent().remove(ad)
+        content_box = self.adapter.chapter_content(current_page)[0]
+        for remove in self.adapter.remove:
+            for element in remove(content_box):
+                if element.getparent() is not None:
+                    element.getparent().remove(element)
         content_box = etree.tostring(content_box, encoding='unicode', method='html')
         chapter.paragraphs.append(Paragraph(type=Paragraph.ParagraphType.HTML, content=self.process_text(content_box)))
+        self.prefetch_images(chapter)
         print("Parsed chapter: " + chapter.metadata.chapter_name)
-        if self.current_page_url == self.config.crawler_stop_page:
-            self.current_page_url = None
-        else:
-            self.current_page_url = self.config.root_url + current_page.xpath(self.config.next_page_xpath)[0].attrib['href']
-        return chapter
+        return chapter, current_page
 
     def process_text(self, text: str) -> str:
         """
@@ -121,15 +261,24 @@ class UniversalCrawler(BaseCrawler):
         """
         text = text.replace('color: #444444;', '')
         text = text.replace('background-color: #ffffff;', '')
-        converter = opencc.OpenCC('t2s')
-        text = converter.convert(text)
-        for replace_str in self.config.replace_str_list:
-            text = text.replace(replace_str.replace_str, replace_str.replace_to)
-        return text
+        if self.text_converter is not None:
+            text = self.text_converter.convert(text)
+        return self.adapter.replace(text)
 
-    def _get_html(self, url: str) -> str:
-        r = requests.get(url, headers=self.headers)
-        return r.content.decode(self.config.encoding)
+    def encoding_for(self, r: fetch.FetchResult) -> str:
+        return charset.detector.encoding_for(r, None if self.config.encoding == 'auto' else self.config.encoding)
+
+    def to_document(self, r: fetch.FetchResult) -> etree._Element:
+        """
+        Parse the raw body, lxml decodes the bytes itself once the encoding is known
+        :param r:
+        :return:
+        """
+        encoding = self.encoding_for(r)
+        try:
+            return etree.HTML(r.content, etree.HTMLParser(encoding=encoding))
+        except LookupError:
+            return etree.HTML(r.content.decode(encoding, errors='replace'))
 
 
 if __name__ == "__main__":
@@ -140,4 +289,3 @@ if __name__ == "__main__":
     })
     crawler.run()
     crawler.save_as_epub()
-